@@ -1,5 +1,5 @@
 from django.contrib import admin
-from cache.models import Reel, Sound, TwitterUser
+from cache.models import Reel, Sound, TwitterUser, MirrorTable, MediaHash, SyncWatermark
 
 
 @admin.register(Reel)
@@ -15,3 +15,19 @@ class SoundAdmin(admin.ModelAdmin):
 @admin.register(TwitterUser)
 class TwitterUserAdmin(admin.ModelAdmin):
     search_fields = ['rapid_id']
+
+
+@admin.register(MirrorTable)
+class MirrorTableAdmin(admin.ModelAdmin):
+    list_display = ['base', 'table', 'synced_at', 'full_synced_at']
+
+
+@admin.register(SyncWatermark)
+class SyncWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['base', 'table', 'synced_at', 'full_synced_at']
+
+
+@admin.register(MediaHash)
+class MediaHashAdmin(admin.ModelAdmin):
+    list_display = ['media_id', 'path', 'size', 'created_at']
+    search_fields = ['media_id', 'path', 'hash']
@@ -0,0 +1,41 @@
+from asgiref.sync import sync_to_async
+from cache.models import TwitterUser
+from libs.utils import chunks
+
+
+class TwitterUserDedup:
+    # Set-based replacement for TwitterUser.objects.get/create per follower:
+    # claim() takes a batch of ids, asks the db once per `chunk_size` ids
+    # which of them are known and inserts the rest in one bulk_create. Every
+    # id seen is kept in `known`, later batches of the run do not touch the
+    # db for them.
+    def __init__(self, chunk_size=1000):
+        self.chunk_size = chunk_size
+        self.known = set()
+
+    def __contains__(self, rapid_id):
+        return rapid_id in self.known
+
+    def find(self, ids):
+        found = set()
+        for part in chunks(ids, self.chunk_size):
+            found.update(TwitterUser.objects.filter(rapid_id__in=part).values_list('rapid_id', flat=True))
+        return found
+
+    def claim_sync(self, ids):
+        ids = [id_ for id_ in dict.fromkeys(map(str, ids)) if id_ not in self.known]
+        if not ids:
+            return []
+        found = self.find(ids)
+        new = [id_ for id_ in ids if id_ not in found]
+        # ignore_conflicts - another run may insert the same id meanwhile
+        TwitterUser.objects.bulk_create(
+            [TwitterUser(rapid_id=id_) for id_ in new],
+            batch_size=self.chunk_size, ignore_conflicts=True
+        )
+        self.known.update(ids)
+        return new
+
+    async def claim(self, ids):
+        # ids not seen before (in the db or in this run), in input order
+        return await sync_to_async(self.claim_sync, thread_sensitive=True)(ids)
@@ -0,0 +1,32 @@
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from cache.models import MediaHash
+from libs.logs import execution_logger
+
+
+class MediaHashCache:
+    # Persistent hash cache for Loader(hash_cache=...): a media downloaded on
+    # an earlier run is not downloaded again while its row is younger than
+    # `ttl`. Expired rows are removed once per process, on first use.
+    def __init__(self, ttl=timedelta(days=30)):
+        self.ttl = ttl
+        self.evicted = False
+        self.hits = 0
+
+    async def get(self, url, media_id=None, partial=0):
+        if not self.evicted:
+            self.evicted = True
+            removed = await sync_to_async(MediaHash.objects.evict, thread_sensitive=True)(self.ttl)
+            execution_logger.info(f"Media hash cache: {removed} expired")
+        item = await sync_to_async(MediaHash.objects.lookup, thread_sensitive=True)(
+            url, media_id, partial, self.ttl
+        )
+        if item is None:
+            return None
+        self.hits += 1
+        return item.hash
+
+    async def set(self, url, hash_, size, media_id=None, partial=0, duration=0):
+        await sync_to_async(MediaHash.objects.store, thread_sensitive=True)(
+            url, hash_, size, media_id, partial, duration
+        )
@@ -0,0 +1,97 @@
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from cache.models import SyncWatermark
+from cache.repository import ReelRepository, SoundRepository, TwitterUserRepository
+from libs.logs import execution_logger
+
+
+async def to_rows(pages, field, extra=None):
+    # Airtable record pages -> cache rows, records without `field` (or
+    # with "0") are skipped
+    async for records in pages:
+        rows = []
+        for record in records:
+            id_ = record['fields'].get(field, '0')
+            if id_ != '0':
+                rows.append({'airtabel_id': record['id'], 'rapid_id': str(id_), **(extra or {})})
+        yield rows
+
+
+async def ingest(repository, pages, field, update=(), extra=None):
+    # Streams the pages into the repository staging table while they are
+    # downloaded and merges them with one INSERT ... ON CONFLICT. update=()
+    # keeps rows that are already cached, None rewrites them.
+    update = None if update is None else list(update)
+    return await repository.copy(to_rows(pages, field, extra), update)
+
+
+class IncrementalIngest:
+    # Keeps a cache table in step with an Airtable table (records keyed by
+    # airtabel_id). sync() asks only for records modified since the last
+    # sync (SyncWatermark, minus `overlap` for clock skew) and merges them:
+    # new records are inserted, changed ones updated. Deleted records, and
+    # records that left the view, do not show up in such an export, so
+    # every `full_every` (and on the first run) the whole table is exported
+    # and the rows of records missing from it lose their airtabel_id (the
+    # rows themselves stay, see Repository.copy).
+    #
+    # `export(formula)` gives the record pages for a filterByFormula (None
+    # for everything), `update` - the columns taken from Airtable.
+    def __init__(self, repository, base, table, field, export, update=('airtabel_id',), full_every=timedelta(days=7), overlap=timedelta(minutes=5)):
+        self.repository = repository
+        self.base = base
+        self.table = table
+        self.field = field
+        self.export = export
+        self.update = list(update)
+        self.full_every = full_every
+        self.overlap = overlap
+
+    def get_watermark(self):
+        watermark, _ = SyncWatermark.objects.get_or_create(base=self.base, table=self.table)
+        return watermark
+
+    def finish(self, watermark, started, full):
+        if full:
+            watermark.full_synced_at = started
+        watermark.synced_at = started
+        watermark.save()
+
+    async def sync(self, full=False):
+        watermark = await sync_to_async(self.get_watermark, thread_sensitive=True)()
+        started = timezone.now()
+        if watermark.synced_at is None or watermark.full_synced_at is None:
+            full = True
+        elif started - watermark.full_synced_at > self.full_every:
+            full = True
+
+        formula = None
+        if not full:
+            since = (watermark.synced_at - self.overlap).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            formula = f"IS_AFTER(LAST_MODIFIED_TIME(), '{since}')"
+
+        count = await self.repository.copy(
+            to_rows(self.export(formula), self.field), self.update,
+            record='airtabel_id', prune=full
+        )
+        await sync_to_async(self.finish, thread_sensitive=True)(watermark, started, full)
+        execution_logger.info(f"Sync {self.base}/{self.table}: {'full' if full else 'incremental'}, {count} records")
+        return {'full': full, 'records': count}
+
+
+# source -> (token setting, base, table, view, id field, repository, extra fields)
+SOURCES = {
+    'reels': ('AIRTABLE_TOKEN', 'Instagram', 'IG Reels', 'Reels For Cache', 'Reel ID', ReelRepository, {}),
+    'sounds': ('AIRTABLE_TOKEN', 'Instagram', 'Sounds', 'All Sounds', 'Sound ID', SoundRepository, {}),
+    'twitter_accounts': (
+        'AIRTABLE_TOKEN_Twitter', 'Twitter E-Mail Scraping Automation', 'Twitter Profiles',
+        '1. All Accounts', 'User ID', TwitterUserRepository,
+        {'base': 'Twitter E-Mail Scraping Automation', 'table': 'Twitter Profiles'}
+    ),
+    'twitter_followers': (
+        'AIRTABLE_TOKEN_Twitter', 'Twitter E-Mail Scraping Automation', 'Scraped Followers',
+        '1. All Accounts', 'User ID', TwitterUserRepository,
+        {'base': 'Twitter E-Mail Scraping Automation', 'table': 'Scraped Followers'}
+    ),
+}
@@ -0,0 +1,39 @@
+import asyncio
+import time
+from django.core.management.base import BaseCommand
+from libs import settings
+from libs.api import AirtableApi
+from libs.session import session_pool
+from libs.archive import request_archive
+from cache.ingest import SOURCES, ingest
+from cache.repository import database
+
+
+class Command(BaseCommand):
+    help = 'Loads Airtable tables into the cache tables (COPY + INSERT ... ON CONFLICT)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+', choices=list(SOURCES), help='in this order, the first one wins on repeated ids')
+        parser.add_argument('--update', action='store_true', help='rewrite rows that are already cached')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options['sources'], None if options['update'] else ()))
+
+    async def run(self, sources, update):
+        apis = {}
+        try:
+            for source in sources:
+                token, base, table, view, field, repository, extra = SOURCES[source]
+                if (token, base) not in apis:
+                    api = AirtableApi("https://api.airtable.com/v0/", getattr(settings, token))
+                    await api.init(base)
+                    apis[(token, base)] = api
+                api = apis[(token, base)]
+                start = time.monotonic()
+                pages = api.iter_search(base, table, None, view, [field])
+                count = await ingest(repository(), pages, field, update, extra)
+                self.stdout.write(f'{source}: {count} rows in {time.monotonic() - start:.1f}s')
+        finally:
+            await database.close()
+            await request_archive.close()
+            await session_pool.close()
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cache', '0003_twitteruser'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MirrorTable',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base', models.CharField(max_length=80)),
+                ('table', models.CharField(max_length=80)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('full_synced_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'unique_together': {('base', 'table')},
+            },
+        ),
+        migrations.CreateModel(
+            name='MirrorRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('airtabel_id', models.CharField(max_length=32)),
+                ('fields', models.JSONField(blank=True, default=dict)),
+                ('mirror', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='records', to='cache.mirrortable')),
+            ],
+            options={
+                'unique_together': {('mirror', 'airtabel_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='MirrorValue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=80)),
+                ('value', models.TextField()),
+                ('value_ci', models.TextField()),
+                ('mirror', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cache.mirrortable')),
+                ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='values', to='cache.mirrorrecord')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['mirror', 'field', 'value'], name='cache_mirro_mirror__7c4157_idx'), models.Index(fields=['mirror', 'field', 'value_ci'], name='cache_mirro_mirror__d4e62c_idx')],
+            },
+        ),
+    ]
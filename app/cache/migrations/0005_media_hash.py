@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cache', '0004_mirror'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaHash',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('media_id', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('path', models.CharField(max_length=255)),
+                ('partial', models.IntegerField(default=0)),
+                ('hash', models.CharField(max_length=96)),
+                ('size', models.BigIntegerField(default=0)),
+                ('duration', models.FloatField(blank=True, default=0)),
+                ('created_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'unique_together': {('path', 'partial')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cache', '0005_media_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base', models.CharField(max_length=80)),
+                ('table', models.CharField(max_length=80)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('full_synced_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'unique_together': {('base', 'table')},
+            },
+        ),
+    ]
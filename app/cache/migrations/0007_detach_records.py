@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cache', '0006_sync_watermark'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reel',
+            name='airtabel_id',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='sound',
+            name='airtabel_id',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True, unique=True),
+        ),
+    ]
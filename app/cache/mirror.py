@@ -0,0 +1,121 @@
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils import timezone
+from cache.models import MirrorTable, MirrorRecord, MirrorValue
+from libs.logs import execution_logger
+
+
+class AirtableMirror:
+    # Local copy of one Airtable table for lookups that used to go through
+    # AirtableApi.search_by_formula. Records live in MirrorRecord, the fields
+    # listed in `indexed` are also stored in MirrorValue (exact and
+    # LOWER(TRIM()) form) with an index, so an equality lookup is one query.
+    #
+    # sync() pulls only records changed since the last sync using
+    # LAST_MODIFIED_TIME(), a full pass (which also drops records deleted in
+    # Airtable) runs on the first sync and then every `full_every`.
+    def __init__(self, api, base, table, indexed, fields=None, view=None, full_every=timedelta(days=1), overlap=timedelta(minutes=5)):
+        self.api = api
+        self.base = base
+        self.table = table
+        self.indexed = indexed
+        self.fields = list(dict.fromkeys([*indexed, *(fields or [])]))
+        self.view = view
+        self.full_every = full_every
+        self.overlap = overlap
+        self.mirror = None
+
+    def get_mirror(self):
+        if self.mirror is None:
+            self.mirror, _ = MirrorTable.objects.get_or_create(base=self.base, table=self.table)
+        return self.mirror
+
+    @staticmethod
+    def normalize(value):
+        return str(value).strip().lower()
+
+    def values_for(self, record, fields):
+        for field in self.indexed:
+            value = fields.get(field)
+            if value is None:
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict):
+                    continue
+                item = str(item)
+                yield MirrorValue(
+                    mirror=self.mirror, record=record, field=field,
+                    value=item, value_ci=self.normalize(item)
+                )
+
+    def apply(self, records):
+        mirror = self.get_mirror()
+        by_id = {record['id']: record.get('fields', {}) for record in records}
+        with transaction.atomic():
+            existing = {
+                record.airtabel_id: record
+                for record in MirrorRecord.objects.filter(mirror=mirror, airtabel_id__in=by_id)
+            }
+            for airtabel_id, record in existing.items():
+                record.fields = by_id[airtabel_id]
+            MirrorRecord.objects.bulk_update(existing.values(), ['fields'])
+            created = MirrorRecord.objects.bulk_create([
+                MirrorRecord(mirror=mirror, airtabel_id=airtabel_id, fields=fields)
+                for airtabel_id, fields in by_id.items() if airtabel_id not in existing
+            ])
+            MirrorValue.objects.filter(record__in=existing.values()).delete()
+            values = []
+            for record in [*existing.values(), *created]:
+                values.extend(self.values_for(record, record.fields))
+            MirrorValue.objects.bulk_create(values)
+        return len(by_id)
+
+    def finish(self, started, full, seen):
+        mirror = self.get_mirror()
+        if full:
+            MirrorRecord.objects.filter(mirror=mirror).exclude(airtabel_id__in=seen).delete()
+            mirror.full_synced_at = started
+        mirror.synced_at = started
+        mirror.save()
+
+    async def sync(self, full=False):
+        mirror = await sync_to_async(self.get_mirror, thread_sensitive=True)()
+        started = timezone.now()
+        if mirror.synced_at is None or mirror.full_synced_at is None:
+            full = True
+        elif started - mirror.full_synced_at > self.full_every:
+            full = True
+
+        formula = None
+        if not full:
+            since = (mirror.synced_at - self.overlap).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            formula = f"IS_AFTER(LAST_MODIFIED_TIME(), '{since}')"
+
+        apply = sync_to_async(self.apply, thread_sensitive=True)
+        seen = []
+        count = 0
+        async for records in self.api.iter_search(self.base, self.table, None, self.view, self.fields, formula):
+            count += await apply(records)
+            seen.extend(record['id'] for record in records)
+        await sync_to_async(self.finish, thread_sensitive=True)(started, full, seen)
+        execution_logger.info(f"Mirror {self.base}/{self.table}: {'full' if full else 'incremental'} sync, {count} records")
+        return count
+
+    def find(self, where, ci=False):
+        query = MirrorRecord.objects.filter(mirror=self.get_mirror())
+        for field, value in where.items():
+            if ci:
+                query = query.filter(values__field=field, values__value_ci=self.normalize(value))
+            else:
+                query = query.filter(values__field=field, values__value=str(value))
+        return query.order_by('id').values_list('airtabel_id', flat=True).first()
+
+    async def lookup(self, where, ci=False):
+        # Same answer as search_by_formula for AND({field}="value", ...):
+        # the first matching record id or None. ci=True compares
+        # LOWER(TRIM()) of both sides.
+        for field in where:
+            if field not in self.indexed:
+                raise Exception(f'Field is not indexed in {self.table} mirror: {field}')
+        return await sync_to_async(self.find, thread_sensitive=True)(where, ci)
@@ -1,8 +1,13 @@
+from datetime import timedelta
+from urllib.parse import urlsplit
 from django.db import models
+from django.utils import timezone
 
 
 class Reel(models.Model):
-    airtabel_id = models.CharField(max_length=32, unique=True, db_index=True)
+    # null - the record left the synced view (cache.ingest), the row and
+    # what other scripts stored on it stay
+    airtabel_id = models.CharField(max_length=32, unique=True, db_index=True, null=True, blank=True)
     rapid_id = models.CharField(max_length=32, unique=True, db_index=True)
 
     account_username = models.CharField(max_length=64, blank=True)
@@ -15,7 +20,7 @@ class Reel(models.Model):
 
 
 class Sound(models.Model):
-    airtabel_id = models.CharField(max_length=32, unique=True, db_index=True)
+    airtabel_id = models.CharField(max_length=32, unique=True, db_index=True, null=True, blank=True)
     rapid_id = models.CharField(max_length=32, unique=True, db_index=True)
 
 
@@ -23,3 +28,100 @@ class TwitterUser(models.Model):
     rapid_id = models.CharField(max_length=48, unique=True, db_index=True)
     base = models.CharField(max_length=80, blank=True)
     table = models.CharField(max_length=52, blank=True)
+
+
+class MirrorTable(models.Model):
+    base = models.CharField(max_length=80)
+    table = models.CharField(max_length=80)
+    synced_at = models.DateTimeField(null=True, blank=True)
+    full_synced_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [('base', 'table')]
+
+
+class MirrorRecord(models.Model):
+    mirror = models.ForeignKey(MirrorTable, on_delete=models.CASCADE, related_name='records')
+    airtabel_id = models.CharField(max_length=32)
+    fields = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        unique_together = [('mirror', 'airtabel_id')]
+
+
+class MirrorValue(models.Model):
+    # One row per indexed field value (list fields give one row per item),
+    # value_ci is the LOWER(TRIM()) form for case-insensitive lookups.
+    mirror = models.ForeignKey(MirrorTable, on_delete=models.CASCADE)
+    record = models.ForeignKey(MirrorRecord, on_delete=models.CASCADE, related_name='values')
+    field = models.CharField(max_length=80)
+    value = models.TextField()
+    value_ci = models.TextField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['mirror', 'field', 'value']),
+            models.Index(fields=['mirror', 'field', 'value_ci']),
+        ]
+
+
+class SyncWatermark(models.Model):
+    # Last export of an Airtable table into a cache table (cache.ingest),
+    # the next incremental one asks for records modified after synced_at.
+    base = models.CharField(max_length=80)
+    table = models.CharField(max_length=80)
+    synced_at = models.DateTimeField(null=True, blank=True)
+    full_synced_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [('base', 'table')]
+
+
+class MediaHashManager(models.Manager):
+    # Hashes are looked up by media id first (CDN urls of one media change
+    # between runs) and then by the CDN path without host and query. Rows
+    # older than `ttl` are ignored and removed by evict().
+    @staticmethod
+    def normalize(url):
+        return urlsplit(url).path
+
+    def fresh(self, ttl):
+        return self.filter(created_at__gte=timezone.now() - ttl)
+
+    def lookup(self, url, media_id=None, partial=0, ttl=timedelta(days=30)):
+        query = self.fresh(ttl).filter(partial=partial)
+        if media_id:
+            found = query.filter(media_id=media_id).order_by('-created_at').first()
+            if found is not None:
+                return found
+        return query.filter(path=self.normalize(url)).order_by('-created_at').first()
+
+    def store(self, url, hash_, size, media_id=None, partial=0, duration=0):
+        item, _ = self.update_or_create(
+            path=self.normalize(url), partial=partial,
+            defaults={
+                'media_id': media_id or '', 'hash': hash_, 'size': size,
+                'duration': duration or 0, 'created_at': timezone.now()
+            }
+        )
+        return item
+
+    def evict(self, ttl=timedelta(days=30)):
+        return self.filter(created_at__lt=timezone.now() - ttl).delete()[0]
+
+
+class MediaHash(models.Model):
+    # media_id identifies one file, not a post: a reel has a video and a
+    # cover image. `partial` is the Loader fingerprint size, 0 - full sha256.
+    media_id = models.CharField(max_length=64, blank=True, db_index=True)
+    path = models.CharField(max_length=255)
+    partial = models.IntegerField(default=0)
+    hash = models.CharField(max_length=96)
+    size = models.BigIntegerField(default=0)
+    duration = models.FloatField(default=0, blank=True)
+    created_at = models.DateTimeField(db_index=True)
+
+    objects = MediaHashManager()
+
+    class Meta:
+        unique_together = [('path', 'partial')]
@@ -0,0 +1,200 @@
+import asyncio
+from django.conf import settings
+from psycopg import sql
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from cache.models import Reel, Sound, TwitterUser
+from libs.utils import chunks
+
+
+class Database:
+    # psycopg3 async pool on the Django "default" database. Queries run on
+    # the event loop, several of them at once (one connection each), next to
+    # the HTTP work - sync_to_async(thread_sensitive=True) runs every ORM
+    # call on one shared thread. Opened on first use, closed by close().
+    def __init__(self, min_size=1, max_size=20):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self.lock = asyncio.Lock()
+
+    def conninfo(self):
+        db = settings.DATABASES['default']
+        return make_conninfo(
+            dbname=db['NAME'], user=db['USER'], password=db['PASSWORD'],
+            host=db['HOST'], port=db['PORT']
+        )
+
+    async def get_pool(self):
+        async with self.lock:
+            if self.pool is None:
+                pool = AsyncConnectionPool(
+                    self.conninfo(), min_size=self.min_size,
+                    max_size=self.max_size, open=False
+                )
+                await pool.open()
+                self.pool = pool
+        return self.pool
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+
+database = Database()
+
+
+class Repository:
+    # Table of one cache model, rows are dicts of field name -> value.
+    # Missing fields get the model default (Django defaults are not db
+    # defaults). `key` is the unique column upserts conflict on.
+    model = None
+    key = 'rapid_id'
+
+    def __init__(self, db=database, chunk_size=1000):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+        self.columns = [field.column for field in self.fields]
+        self.table = self.model._meta.db_table
+
+    def prepare(self, row):
+        return tuple(
+            row[field.name] if field.name in row else field.get_default()
+            for field in self.fields
+        )
+
+    def merge_sql(self, source, update):
+        # INSERT INTO <table> SELECT FROM <source> ON CONFLICT (key) ...
+        # update=None - every column but the key, [] - keep existing rows
+        # (a conflict on any unique column skips the row)
+        if update is None:
+            update = [column for column in self.columns if column != self.key]
+        columns = sql.SQL(', ').join(map(sql.Identifier, self.columns))
+        if update:
+            action = sql.SQL('DO UPDATE SET {}').format(sql.SQL(', ').join(
+                sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(column))
+                for column in update
+            ))
+            target = sql.SQL('({})').format(sql.Identifier(self.key))
+        else:
+            action = sql.SQL('DO NOTHING')
+            target = sql.SQL('')
+        return sql.SQL('INSERT INTO {table} ({columns}) {source} ON CONFLICT {target} {action}').format(
+            table=sql.Identifier(self.table), columns=columns, source=source,
+            target=target, action=action
+        )
+
+    async def find(self, values, fields=None):
+        # {key value: row} for the rows that exist, one ANY(%s) query per
+        # chunk, the chunks run at once
+        fields = fields or [self.key, *[column for column in self.columns if column != self.key]]
+        query = sql.SQL('SELECT {fields} FROM {table} WHERE {key} = ANY(%s)').format(
+            fields=sql.SQL(', ').join(map(sql.Identifier, fields)),
+            table=sql.Identifier(self.table), key=sql.Identifier(self.key)
+        )
+        pool = await self.db.get_pool()
+
+        async def part(values):
+            async with pool.connection() as connection:
+                cursor = connection.cursor(row_factory=dict_row)
+                await cursor.execute(query, [values])
+                return await cursor.fetchall()
+
+        found = {}
+        values = [str(value) for value in dict.fromkeys(values)]
+        for rows in await asyncio.gather(*[part(values) for values in chunks(values, self.chunk_size)]):
+            for row in rows:
+                found[row[self.key]] = row
+        return found
+
+    async def upsert(self, rows, update=None):
+        # INSERT ... ON CONFLICT for a few thousand rows, the statements of
+        # one call are pipelined on one connection
+        rows = list(rows)
+        if not rows:
+            return 0
+        query = self.merge_sql(sql.SQL('VALUES ({})').format(
+            sql.SQL(', ').join(sql.Placeholder() * len(self.columns))
+        ), update)
+        pool = await self.db.get_pool()
+        async with pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.executemany(query, [self.prepare(row) for row in rows])
+        return len(rows)
+
+    async def copy(self, rows, update=None, record=None, prune=False):
+        # Bulk ingest: COPY into a temporary staging table, then one
+        # INSERT ... SELECT ... ON CONFLICT. `rows` may be an async iterable
+        # of lists (Airtable pages), they are streamed as they come.
+        # Repeated keys keep the first row. Returns the number of rows copied.
+        # record='airtabel_id' - the column of the source record (nullable):
+        # a row of a copied record with another key loses the record (the
+        # record changed its id), with prune=True so do the rows of records
+        # that were not copied (only for a full export). Rows are never
+        # deleted, columns other scripts wrote (video_hash) stay, a record
+        # that comes back gets its row again.
+        staging = sql.Identifier(f'staging_{self.table}')
+        columns = sql.SQL(', ').join(map(sql.Identifier, self.columns))
+        count = 0
+        pool = await self.db.get_pool()
+        async with pool.connection() as connection:
+            async with connection.transaction():
+                # CREATE TABLE AS does not copy NOT NULL of the id column
+                await connection.execute(sql.SQL(
+                    'CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS SELECT {columns} FROM {table} WITH NO DATA'
+                ).format(staging=staging, columns=columns, table=sql.Identifier(self.table)))
+                await connection.execute(sql.SQL('ALTER TABLE {staging} ADD COLUMN n BIGSERIAL').format(staging=staging))
+                async with connection.cursor().copy(sql.SQL('COPY {staging} ({columns}) FROM STDIN').format(
+                    staging=staging, columns=columns
+                )) as copy:
+                    async for page in aiter_pages(rows):
+                        # one write per page, write_row() per row costs more
+                        # than the COPY itself
+                        await copy.write(''.join(copy_line(self.prepare(row)) for row in page))
+                        count += len(page)
+                if record is not None:
+                    await connection.execute(sql.SQL(
+                        'UPDATE {table} t SET {record} = NULL FROM {staging} s WHERE t.{record} = s.{record} AND t.{key} <> s.{key}'
+                    ).format(table=sql.Identifier(self.table), staging=staging, record=sql.Identifier(record), key=sql.Identifier(self.key)))
+                    if prune:
+                        await connection.execute(sql.SQL(
+                            'UPDATE {table} t SET {record} = NULL WHERE t.{record} IS NOT NULL '
+                            'AND NOT EXISTS (SELECT 1 FROM {staging} s WHERE s.{record} = t.{record})'
+                        ).format(table=sql.Identifier(self.table), staging=staging, record=sql.Identifier(record)))
+                await connection.execute(self.merge_sql(sql.SQL(
+                    'SELECT DISTINCT ON ({key}) {columns} FROM {staging} ORDER BY {key}, n'
+                ).format(key=sql.Identifier(self.key), columns=columns, staging=staging), update))
+        return count
+
+
+COPY_ESCAPE = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_line(values):
+    # one row in COPY text format
+    return '\t'.join(
+        '\\N' if value is None else str(value).translate(COPY_ESCAPE) for value in values
+    ) + '\n'
+
+
+async def aiter_pages(rows):
+    if hasattr(rows, '__aiter__'):
+        async for page in rows:
+            yield page
+    else:
+        yield rows
+
+
+class ReelRepository(Repository):
+    model = Reel
+
+
+class SoundRepository(Repository):
+    model = Sound
+
+
+class TwitterUserRepository(Repository):
+    model = TwitterUser
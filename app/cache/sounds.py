@@ -0,0 +1,65 @@
+import asyncio
+from collections import OrderedDict
+from cache.models import Sound
+from cache.repository import SoundRepository
+from libs.logs import error_logger
+
+
+class SoundResolver:
+    # Sound ID -> cached Sound, in three tiers:
+    # - an LRU of the last `size` sounds in memory
+    # - the Sound table, prefetch() loads all sounds of a page of reels in
+    #   one query (a row without airtabel_id - the record is gone - counts
+    #   as missing)
+    # - Airtable: a missing sound is created through `queue` (a write
+    #   queue, 10 records per request) and stored in the Sound table.
+    # Concurrent misses of one sound share a single lookup/create.
+    def __init__(self, queue, size=10000, repository=None):
+        self.queue = queue
+        self.size = size
+        self.repository = repository or SoundRepository()
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.created = 0
+
+    def remember(self, rapid_id, airtabel_id):
+        self.cache[rapid_id] = airtabel_id
+        self.cache.move_to_end(rapid_id)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    async def prefetch(self, rapid_ids):
+        missing = [str(id_) for id_ in rapid_ids if str(id_) not in self.cache]
+        if missing:
+            for rapid_id, row in (await self.repository.find(missing, ['rapid_id', 'airtabel_id'])).items():
+                if row['airtabel_id']:
+                    self.remember(rapid_id, row['airtabel_id'])
+
+    async def load(self, sound):
+        rapid_id = sound['Sound ID']
+        row = (await self.repository.find([rapid_id], ['rapid_id', 'airtabel_id'])).get(rapid_id)
+        if row is not None and row['airtabel_id']:
+            return row['airtabel_id']
+        record = await self.queue.create(sound)
+        if 'id' not in record:
+            error_logger.error(f'Sound {rapid_id} was not created: {record}')
+            return None
+        self.created += 1
+        await self.repository.upsert([{'rapid_id': rapid_id, 'airtabel_id': record['id']}], update=['airtabel_id'])
+        return record['id']
+
+    async def resolve(self, sound):
+        # `sound` - the Airtable fields of the sound, None when it could not
+        # be found or created
+        rapid_id = sound['Sound ID']
+        if rapid_id in self.cache:
+            self.cache.move_to_end(rapid_id)
+            return Sound(rapid_id=rapid_id, airtabel_id=self.cache[rapid_id])
+        if rapid_id not in self.pending:
+            self.pending[rapid_id] = asyncio.ensure_future(self.load(sound))
+            self.pending[rapid_id].add_done_callback(lambda _: self.pending.pop(rapid_id, None))
+        airtabel_id = await asyncio.shield(self.pending[rapid_id])
+        if airtabel_id is None:
+            return None
+        self.remember(rapid_id, airtabel_id)
+        return Sound(rapid_id=rapid_id, airtabel_id=airtabel_id)
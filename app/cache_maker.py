@@ -3,11 +3,13 @@ import libs.init
 
 from libs.api import AirtableApi, _request_counter
 from libs.settings import AIRTABLE_TOKEN
-from libs.utils import chunks
-from datetime import datetime
+from datetime import datetime, timedelta
 from libs.makepipeline import Step, Const, OUT
-from cache.models import Reel, Sound
-from asgiref.sync import sync_to_async
+from cache.repository import ReelRepository, SoundRepository, database
+from cache.ingest import ingest, IncrementalIngest
+from sys import argv
+
+# python cache_maker.py [full]
 
 const = Const(
     BASE='Instagram',
@@ -16,12 +18,23 @@ const = Const(
     SOUNDS_VIEW='All Sounds',
     SOUNDS='Sounds',
     REELS_FIELDS=["Name", "Reel ID"],
-    SOUNDS_FIELDS=["Sound Title", "Sound ID"]
+    SOUNDS_FIELDS=["Sound Title", "Sound ID"],
+    # > 1 splits every export by CREATED_TIME() and pulls the parts at once
+    PARTITIONS=1,
+    PARTITION_START=datetime(2023, 1, 1),
+    # only records modified since the last run, a full pass (which also
+    # detaches the rows of deleted records) every FULL_EVERY or with "full";
+    # False - add new records only, like before
+    INCREMENTAL=True,
+    FULL_EVERY=timedelta(days=7),
+    FULL='full' in argv[1:]
 )
 
 airtabel = AirtableApi(
     "https://api.airtable.com/v0/", AIRTABLE_TOKEN
 )
+reels = ReelRepository()
+sounds = SoundRepository()
 
 if __name__ == '__main__':
 
@@ -30,78 +43,41 @@ if __name__ == '__main__':
         await airtabel.init(const.BASE)
         airtabel.dump_cache("airtable_db.json")
 
-    async def _step2(data: None, context, const, pipe, iteration, step_number) -> dict:
-        reels = await airtabel.search_until(
-            const.BASE, const.REELS, None, const.REELS_VIEW,
-            const.REELS_FIELDS
-        )
-        sounds = await airtabel.search_until(
-            const.BASE, const.SOUNDS, None, const.SOUNDS_VIEW,
-            const.SOUNDS_FIELDS
-        )
-        return [reels, sounds]
-
-    async def _step3(data: dict, context, const, pipe, iteration, step_number) -> list:
-        reels, sounds = data
-        for_create_reels = []
-        for_create_sounds = []
-        for reel in reels['records']:
-            id_ = reel['fields'].get('Reel ID', '0')
-            if id_ != '0':
-                for_create_reels.append({
-                    'airtabel_id': reel['id'],
-                    'rapid_id': id_
-                })
-        for sound in sounds['records']:
-            id_ = sound['fields'].get('Sound ID', '0')
-            if id_ != '0':
-                for_create_sounds.append({
-                    'airtabel_id': sound['id'],
-                    'rapid_id': id_
-                })
-        return [for_create_reels, for_create_sounds]
-
-    async def _step4(data: dict, context, const, pipe, iteration, step_number) -> list:
-        reels, sounds = data
-        reels_tasks = []
-        sound_tasks = []
-        reel_check = []
-        for reels in list(chunks(reels, 20)):
-            batch = []
-            for reel in reels:
-                if reel['rapid_id'] not in reel_check:
-                    reel_check.append(reel['rapid_id'])
-                    batch.append(Reel(**reel))
-            reels_tasks.append(batch)
-        del reel_check
-
-        sound_check = []
-        for sounds in list(chunks(sounds, 20)):
-            batch = []
-            for sound in sounds:
-                if sound['rapid_id'] not in sound_check:
-                    sound_check.append(sound['rapid_id'])
-                    batch.append(Reel(**sound))
-            sound_tasks.append(batch)
-        del sound_check
-
-        async_reel_create = sync_to_async(
-            Reel.objects.bulk_create, thread_sensitive=True
-        )
-        async_sound_create = sync_to_async(
-            Sound.objects.bulk_create, thread_sensitive=True
+    def export(table, view, fields, formula=None):
+        if const.PARTITIONS > 1:
+            partitions = airtabel.created_time_partitions(
+                const.PARTITION_START, datetime.utcnow(), const.PARTITIONS
+            )
+            return airtabel.iter_partitions(
+                const.BASE, table, partitions, view, fields, formula
+            )
+        return airtabel.iter_search(const.BASE, table, None, view, fields, formula)
+
+    async def load(repository, table, view, fields, field):
+        # pages go into the COPY as they arrive, raw records are never kept
+        if not const.INCREMENTAL:
+            return {'records': await ingest(repository, export(table, view, fields), field)}
+        sync = IncrementalIngest(
+            repository, const.BASE, table, field,
+            lambda formula: export(table, view, fields, formula),
+            full_every=const.FULL_EVERY
         )
-        tasks = []
-        for reels in reels_tasks:
-            tasks.append(async_reel_create(reels))
-        for sounds in sound_tasks:
-            tasks.append(async_sound_create(sounds))
-        await asyncio.gather(*tasks)
+        return await sync.sync(const.FULL)
+
+    async def _step2(data: None, context, const, pipe, iteration, step_number) -> dict:
+        return await load(reels, const.REELS, const.REELS_VIEW, const.REELS_FIELDS, 'Reel ID')
+
+    async def _step3(data: None, context, const, pipe, iteration, step_number) -> dict:
+        return await load(sounds, const.SOUNDS, const.SOUNDS_VIEW, const.SOUNDS_FIELDS, 'Sound ID')
+
+    async def _step4(data: dict, context, const, pipe, iteration, step_number) -> None:
+        OUT.print(f"Reels: {data['step_2']}, Sounds: {data['step_3']}")
 
     step1 = Step(_step1, name='step_1', const=const)
     step2 = Step(_step2, name='step_2', const=const)
-    step3 = Step(_step3, name='step_3', const=const)
-    step4 = Step(_step4, name='step_4', const=const)
+    # reels and sounds are exported at the same time
+    step3 = Step(_step3, name='step_3', const=const, after=['step_1'])
+    step4 = Step(_step4, name='step_4', const=const, after=['step_2', 'step_3'])
 
     pipe = step1 > step2
     pipe <= step3
@@ -117,5 +93,6 @@ if __name__ == '__main__':
         OUT.print(f"{datetime.now().strftime('%H:%M:%S')} - {elapsed}")
 
     pipe.set_time_handler(time_handler)
+    pipe.on_shutdown(database.close)
 
     asyncio.run(pipe.run_with_timer("Make Cache"))
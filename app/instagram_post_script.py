@@ -1,13 +1,16 @@
 import asyncio
 import libs.init
 
-from libs.api import AirtableApi, RapidApi, Loader, _request_counter
+from libs.api import AirtableApi, RapidApi, older_than, Loader, _request_counter
 from libs.settings import AIRTABLE_TOKEN, XRapidAPIHost, XRapidAPIKey
 from libs.utils import chunks
 from datetime import datetime
 from libs.logs import execution_logger, error_logger
 from libs.makepipeline import Step, Const, OUT
-from cache.models import Sound
+from cache.sounds import SoundResolver
+from cache.repository import database
+from cache.mirror import AirtableMirror
+from cache.hashes import MediaHashCache
 
 
 const = Const(
@@ -30,9 +33,16 @@ rapid = RapidApi(
     {"X-RapidAPI-Key": XRapidAPIKey, "X-RapidAPI-Host": XRapidAPIHost}
 )
 
-L = Loader()
+L = Loader(hash_cache=MediaHashCache())
+# Hash -> original record lookups are answered from the local mirror
+hashes = AirtableMirror(
+    airtabel, const.BASE, const.POSTS, ["Hash", "Duplicate / Original"]
+)
 
 if __name__ == '__main__':
+    # new sounds are created 10 per request
+    sounds = airtabel.write_queue(const.BASE, const.SOUNDS)
+    sound_resolver = SoundResolver(sounds)
 
     async def get_hash(post):
         carousel_media = post.get("carousel_media", [])
@@ -40,17 +50,17 @@ if __name__ == '__main__':
             hash_ = []
             for i in carousel_media:
                 if i["is_video"]:
-                    hash_.append(await L.load_hash(i["video_url"]))
+                    hash_.append(await L.load_hash(i["video_url"], media_id=f'{i["id"]}:video'))
                 else:
-                    hash_.append(await L.load_hash(i["image_versions"]["items"][0]["url"]))
+                    hash_.append(await L.load_hash(i["image_versions"]["items"][0]["url"], media_id=f'{i["id"]}:image'))
             return ";".join(hash_)
         else:
-            return await L.load_hash(post["image_versions"]["items"][0]["url"])
+            return await L.load_hash(post["image_versions"]["items"][0]["url"], media_id=f'{post["id"]}:image')
 
-    async def get_sound(model, const):
+    def parse_sound(model):
         sound = None
-        if model.get("clips_metadata", {}).get("audio_type", "") == "licensed_music":
-            _data = model.get("clips_metadata", {}).get("music_info", {}).get("music_asset_info", None)
+        if (model.get("clips_metadata") or {}).get("audio_type", "") == "licensed_music":
+            _data = ((model.get("clips_metadata") or {}).get("music_info") or {}).get("music_asset_info", None)
             if _data is not None:
                 sound = {
                     "Sound ID": str(_data["audio_id"]),
@@ -58,24 +68,19 @@ if __name__ == '__main__':
                     "Sound Type": "Licensed Music"
                 }
         else:
-            _data = model.get("clips_metadata", {}).get("original_sound_info", None)
+            _data = (model.get("clips_metadata") or {}).get("original_sound_info", None)
             if _data is not None:
                 sound = {
                     "Sound ID": str(_data["audio_id"]),
                     "Sound Title": str(_data["original_audio_title"]),
                     "Sound Type": "Original Sound"
                 }
+        return sound
+
+    async def get_sound(model, const):
+        sound = parse_sound(model)
         if sound:
-            try:
-                cache_obj = await Sound.objects.aget(rapid_id=sound['Sound ID'])
-            except:
-                ai_sound = await airtabel.create(const.BASE, const.SOUNDS, sound)
-                sound_id = ai_sound["id"]
-                cache_obj = Sound(
-                    rapid_id=sound['Sound ID'],
-                    airtabel_id=sound_id
-                )
-                await cache_obj.asave()
+            cache_obj = await sound_resolver.resolve(sound)
             error_logger.info(f'Sound found - {model}')
             return cache_obj
 
@@ -86,6 +91,7 @@ if __name__ == '__main__':
         airtabel.load_cache("airtable_db.json")
         await airtabel.init(const.BASE)
         airtabel.dump_cache("airtable_db.json")
+        await hashes.sync()
 
     async def _step2(data: None, context, const, pipe, iteration, step_number) -> dict:
         if const.USER_COUNT is not None:
@@ -102,7 +108,13 @@ if __name__ == '__main__':
 
     async def _step3(data: dict, context, const, pipe, iteration, step_number) -> list:
         username = data['fields']['Username']
-        answer = await rapid.get_n_page(username, const.URL_MODEL, const.PAGES)
+        stop = None
+        if data["fields"].get("Created"):
+            # without a date every page is loaded, as before the early stop
+            stop = older_than(datetime.strptime(data["fields"]["Created"], "%Y-%m-%d"))
+        answer = await rapid.get_n_page(
+            username, const.URL_MODEL, const.PAGES, stop=stop
+        )
         models = answer.get('answer', [])
         models.sort(key=lambda item: -item.get('taken_at', 0))
         return {'models': models, 'user': data, 'status': answer.get('status')}
@@ -200,18 +212,19 @@ if __name__ == '__main__':
         for items in data:
             _data += items
         execution_logger.info(f"Total: {len(_data)}")
+        # every sound of the run in one query, step 7 reads them from memory
+        await sound_resolver.prefetch([
+            sound['Sound ID'] for sound in map(parse_sound, _data) if sound
+        ])
         return _data
 
     async def _step7(data: dict, context, const, pipe, iteration, step_number) -> dict:
         post = data
 
         hash_ = await get_hash(post)
-        hash_find = f'"{hash_}"' + "={Hash}"
-        is_origin = '"Original Content"={Duplicate / Original}'
-        hash_find = f'AND({hash_find}, {is_origin})'
-        origin_post = await airtabel.search_by_formula(
-            const.BASE, const.POSTS, hash_find
-        )
+        origin_post = await hashes.lookup({
+            "Hash": hash_, "Duplicate / Original": "Original Content"
+        })
         origin = "Original Content"
         if origin_post:
             origin = "Duplicate Content"
@@ -268,17 +281,18 @@ if __name__ == '__main__':
             create += len(part['createdRecords'])
         execution_logger.info(f"Created: {create} Updated: {update}")
 
-    async def _step11(data: dict, context, const, pipe, iteration, step_number) -> list:
-        data = []
-        for item in context[3]['out']:
-            data.append({
+    async def _step11(data: list, context, const, pipe, iteration, step_number) -> list:
+        # gets the output of step 3, runs next to the content branch
+        update = []
+        for item in data:
+            update.append({
                 'id': item['user']['id'],
                 'fields': {
                     "Status": item['status'],
                     "Posts - Last Scraped": datetime.today().strftime("%Y-%m-%d")
                 }
             })
-        return list(chunks(data, 10))
+        return list(chunks(update, 10))
 
     async def _step12(data: dict, context, const, pipe, iteration, step_number) -> dict:
         answer = await airtabel.upsert(
@@ -294,11 +308,11 @@ if __name__ == '__main__':
     step4 = Step(_step4, name='step_4', const=const, isloop='aloop')
     # step5 = Step(_step5, name='step_5', const=const, isloop='aloop')
     step6 = Step(_step6, name='step_6', const=const)
-    step7 = Step(_step7, name='step_7', const=const, isloop='aloop')
+    step7 = Step(_step7, name='step_7', const=const, isloop='aloop', concurrency=50)
     step8 = Step(_step8, name='step_8', const=const)
     step9 = Step(_step9, name='step_9', const=const, isloop='aloop')
     step10 = Step(_step10, name='step_10', const=const)
-    step11 = Step(_step11, name='step_11', const=const)
+    step11 = Step(_step11, name='step_11', const=const, after=['step_3'])
     step12 = Step(_step12, name='step_12', const=const, isloop='aloop')
 
     pipe = step1 > step2
@@ -324,5 +338,6 @@ if __name__ == '__main__':
         self.write_status(self.get_status())
 
     pipe.set_time_handler(time_handler)
+    pipe.on_shutdown(database.close)
 
     asyncio.run(pipe.run_with_timer("Instagram Posts"))
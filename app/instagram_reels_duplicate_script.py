@@ -7,8 +7,15 @@ from libs.utils import chunks
 from datetime import datetime
 from libs.logs import execution_logger, error_logger
 from libs.makepipeline import Step, Const, OUT
-from cache.models import Sound
+from libs.executor import offload
+from libs.fingerprint import video_signature, find_sources
+from libs.matcher import DuplicateMatcher
+from cache.models import Sound, Reel
+from cache.hashes import MediaHashCache
+from asgiref.sync import sync_to_async
 from traceback import format_exc
+from tempfile import TemporaryDirectory
+from pathlib import Path
 
 
 const = Const(
@@ -31,7 +38,7 @@ rapid = RapidApi(
     {"X-RapidAPI-Key": XRapidAPIKey, "X-RapidAPI-Host": XRapidAPIHost}
 )
 
-L = Loader()
+L = Loader(hash_cache=MediaHashCache())
 
 if __name__ == '__main__':
 
@@ -55,11 +62,47 @@ if __name__ == '__main__':
                 }
         return sound
 
-    async def get_hash(model):
-        hash_ = await L.load_hash(model['video_url'])
-        model['hash'] = hash_
+    async def get_hash(model, signatures):
+        # a reel with a stored signature needs only the file hash (usually
+        # cached), the others are downloaded once for the hash and the
+        # keyframes
+        media_id = f"{model['video_id']}:video"
+        model['signature'] = signatures.get(str(model['video_id']))
+        if model['signature']:
+            model['hash'] = await L.load_hash(
+                model['video_url'], media_id=media_id, duration=model['video_duration']
+            )
+            return model
+        with TemporaryDirectory() as folder:
+            path = Path(folder) / 'video.mp4'
+            model['hash'] = await L.load_hash(
+                model['video_url'], media_id=media_id,
+                duration=model['video_duration'], path=path
+            )
+            if model['hash'] != "UNDEFINED HASH":
+                try:
+                    model['signature'] = await offload('process', video_signature, str(path))
+                except Exception:
+                    # the reel is still matched by file hash, sound and duration
+                    error_logger.error(f"Signature failed {model['video_id']}: {format_exc()}")
         return model
 
+    def get_signatures(ids):
+        return dict(
+            Reel.objects.filter(rapid_id__in=ids).exclude(video_hash='')
+            .values_list('rapid_id', 'video_hash')
+        )
+
+    def save_signatures(reels):
+        signatures = {str(reel['video_id']): reel['signature'] for reel in reels if reel['signature']}
+        known = [
+            reel for reel in Reel.objects.filter(rapid_id__in=signatures)
+            if reel.video_hash != signatures[reel.rapid_id]
+        ]
+        for reel in known:
+            reel.video_hash = signatures[reel.rapid_id]
+        Reel.objects.bulk_update(known, ['video_hash'], batch_size=500)
+
     async def _step1(data: None, context, const, pipe, iteration, step_number) -> None:
         airtabel.load_cache("airtable_db.json")
         await airtabel.init(const.BASE)
@@ -86,17 +129,7 @@ if __name__ == '__main__':
         models.sort(key=lambda item: -item['taken_at'])
         return {'models': models, 'user': data, 'model': model, 'status': answer.get('status')}
 
-    async def _step4(data: dict, context, const, pipe, iteration, step_number) -> list:
-        if 'models' not in pipe:
-            pipe['models'] = {}
-
-        if data['model'][0] not in pipe['models']:
-            pipe['models'][data['model'][0]] = {
-                'users': [],
-                'reels': []
-            }
-        pipe['models'][data['model'][0]]['users'].append(data['user'])
-
+    async def _step4(data: dict, context, const, pipe, iteration, step_number) -> dict:
         new_reels = []
         for reel in data['models']:
             sound_data = get_sound(reel)
@@ -112,15 +145,46 @@ if __name__ == '__main__':
                 "sound_data": sound_data,
             }
             new_reels.append(new_reel)
+        signatures = await sync_to_async(get_signatures, thread_sensitive=True)(
+            [str(reel['video_id']) for reel in new_reels]
+        )
         tasks = []
         for reel in new_reels:
-            tasks.append(get_hash(reel))
+            tasks.append(get_hash(reel, signatures))
         new_reels = await asyncio.gather(*tasks)
         new_reels.sort(key=lambda item: -item['taken_at'])
-        pipe['models'][data['model'][0]]['reels'] += new_reels
-
-    async def _step5(data: list, context, const, pipe, iteration, step_number) -> list:
-        return pipe
+        return {'model': data['model'][0], 'user': data['user'], 'reels': new_reels}
+
+    async def _step5(data: list, context, const, pipe, iteration, step_number) -> dict:
+        # oldest reel of a model is the original, later ones with a close
+        # signature are its duplicates, without one the file hash, sound and
+        # duration decide
+        models = {}
+        for item in data:
+            models.setdefault(item['model'], []).extend(item['reels'])
+        for model, reels in models.items():
+            reels.sort(key=lambda item: item['taken_at'])
+            try:
+                sources = await offload('process', find_sources, [reel['signature'] for reel in reels])
+            except Exception:
+                error_logger.error(f"Signature matching failed {model}: {format_exc()}")
+                sources = [-1] * len(reels)
+            matcher = DuplicateMatcher()
+            for reel, source in zip(reels, sources):
+                hash_ = reel['hash'] if reel['hash'] != "UNDEFINED HASH" else None
+                source, is_potential = (reels[source], False) if source != -1 else (None, False)
+                if source is None:
+                    source, is_potential = matcher.match(
+                        hash_, reel['sound_data']['Sound ID'], reel['video_duration']
+                    )
+                matcher.add(source or reel, hash_, reel['sound_data']['Sound ID'], reel['video_duration'])
+                reel['originality'] = source is None
+                reel['is_potential'] = is_potential
+                reel['source'] = None if source is None else source['video_id']
+            duplicates = sum(not reel['originality'] for reel in reels)
+            execution_logger.info(f"{model}: {duplicates}/{len(reels)} duplicates")
+            await sync_to_async(save_signatures, thread_sensitive=True)(reels)
+        return models
 
     async def _step6(data: dict, context, const, pipe, iteration, step_number) -> list:
         sound_data = await get_sound(data, const)
@@ -221,370 +285,4 @@ if __name__ == '__main__':
     pipe.set_exec('28ac2cd8-5e3e-46dd-958b-1aa5ba670eeb', ['step_2', 'step_3'])
 
     asyncio.run(pipe.run_with_timer("Instagram Reels Duplicates"))
-
-exit(0)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-from json import dump, load, dumps
-from utils import deduplicate, add_error_handler
-from cache import Cache
-from sys import stdout
-from pathlib import Path
-from decimal import Decimal
-from csv import DictWriter, DictReader
-
-BASE = "Instagram"
-IG_Accounts = "IG Accounts"
-IG_Reels = "IG Reels"
-Sounds = "Sounds"
-VIEW = "Reels - Duplicate Test"
-PAGES = 14
-PARSED_PAGES = 2
-PAGE_SIZE = 12
-
-ONE_BUTCH_SIZE = 10
-
-
-async def get_all_reels(user, callback=None):
-    reels = await rapid.get_n_page(user, "reels", PAGES, user, callback)
-    my_reels = reels["answer"]
-    return [user, my_reels]
-
-
-async def get_hash(record):
-    hash_ = await L.load_hash(record['video_url'])
-    record["video_hash"] = hash_
-    return [record, hash_]
-
-
-async def get_record(base, table, formula, record, id_):
-    reel = await airtabel.search(
-        base, table, maxRecords=1, filterByFormula=formula
-    )
-    record["reel_id"] = None
-    if len(reel["records"]) > 0:
-        reel_id = reel["records"][0]["id"]
-        record["reel_id"] = reel_id
-    else:
-        reel_id = None
-    return [id_, record]
-
-
-async def get_reels_for(user_map):
-    tasks = []
-    for model, data in user_map.items():
-        for user in data:
-            tasks.append(get_all_reels(user['username']))
-    reels = await asyncio.gather(*tasks)
-    user_map_alt = {}
-    for model, data in user_map.items():
-        for user in data:
-            user_map_alt[user['username']] = {
-                "model": model,
-                "reels": user["reels"]
-            }
-    records = []
-    for user in reels:
-        print(user[0], len(user[1]), user_map_alt[user[0]]['model'])
-        for video in user[1]:
-            try:
-                caption = video.get("caption", {})
-                if caption is None:
-                    caption = {}
-                clip_meta = video.get("clips_metadata", {})
-                if clip_meta is None:
-                    clip_meta = {}
-                music_info = clip_meta.get("music_info", {})
-                if music_info is None:
-                    music_info = {}
-                music_asset_info = music_info.get("music_asset_info", {})
-                if music_asset_info is None:
-                    music_asset_info = {}
-                is_licensed = clip_meta.get("audio_type", "")
-                original_sound_info = clip_meta.get("original_sound_info", {})
-                if original_sound_info is None:
-                    original_sound_info = {}
-                music_consumption_info = music_info.get("music_consumption_info", {})
-                if music_consumption_info is None:
-                    music_consumption_info = {}
-                records.append({
-                    "username": user[0],
-                    "model": user_map_alt[user[0]]['model'],
-                    "video_id": video["id"],
-                    "video_duration": video["video_duration"],
-                    "video_url": video["video_url"],
-                    "code": video["code"],
-                    "caption_id": caption.get("id", ""),
-                    "caption_text": caption.get("text", ""),
-                    "music_type": is_licensed,
-                    "audio_canonical_id": clip_meta.get("audio_canonical_id", ""),
-                    "taken_at": video["taken_at"],
-                    # licensed add markers
-                    "audio_asset_start_time_in_ms": music_consumption_info.get("audio_asset_start_time_in_ms", 0),
-                    "overlap_duration_in_ms": music_consumption_info.get("overlap_duration_in_ms", 0),
-                    "audio_id": music_asset_info.get("audio_id", ""),
-                    "title": music_asset_info.get("title", ""),
-                    # origin add markers
-                    "video_hash": "",
-                    "originality": ""
-                })
-            except:
-                logger.error(f"Video {video}, {format_exc()}")
-    tasks = []
-    for record in records:
-        tasks.append(get_hash(record))
-    await asyncio.gather(*tasks)
-
-    records.sort(key=lambda obj: obj["taken_at"])
-
-    _sources = {}
-    data_for_update = {}
-
-    def check_decimal(sources, value):
-        return (
-            value + Decimal("0.001") in sources or \
-            value - Decimal("0.001") in sources or \
-            value + Decimal("0.002") in sources or \
-            value - Decimal("0.002") in sources or \
-            value in sources
-        )
-
-    def set_potential_decimalal(sources, key, value):
-        sources[key] = value
-        sources[key + Decimal("0.001")] = value
-        sources[key - Decimal("0.001")] = value
-        sources[key + Decimal("0.002")] = value
-        sources[key - Decimal("0.002")] = value
-
-    def get_decimal(sources, key):
-        _value_list = [
-            key,
-            key + Decimal("0.001"),
-            key - Decimal("0.001"),
-            key + Decimal("0.002"),
-            key - Decimal("0.002")
-        ]
-        for value in _value_list:
-            if value in sources:
-                return sources[value]
-
-    for record in records:
-        if record['model'] not in _sources:
-            _sources[record['model']] = {}
-        sources = _sources[record['model']]
-        try:
-            record["originality"] = False
-            hash_ = record["video_hash"]
-            decimal_duration = Decimal(record["video_duration"])
-            if record["music_type"] == "licensed_music":
-                audio_id_and_duration = ("1", record["audio_id"], record["video_duration"])
-                potential_sources_id = ("2", record["audio_id"], round(float(record["video_duration"]), 1))
-            else:
-                audio_id_and_duration = ("1", record["original_audio_id"], record["video_duration"])
-                potential_sources_id = ("2", record["original_audio_id"], round(float(record["video_duration"]), 1))
-
-
-            by_hash = hash_ in list(sources.keys())
-            by_sound_and_duration = audio_id_and_duration in list(sources.keys())
-            by_potential_sources = potential_sources_id in list(sources.keys())
-            by_decimal = check_decimal(list(sources.keys()), decimal_duration)
-
-            have_source = False
-            is_potential = False
-            if by_hash:
-                source_ref = sources[hash_]
-                have_source = True
-            elif by_sound_and_duration:
-                source_ref = sources[audio_id_and_duration]
-                have_source = True
-            elif by_potential_sources:
-                source_ref = sources[potential_sources_id]
-                have_source = True
-                is_potential = True
-            elif by_decimal:
-                source_ref = get_decimal(sources, decimal_duration)
-                have_source = True
-                is_potential = True
-
-            if not have_source:
-                record["originality"] = True
-                sources[hash_] = record
-                sources[audio_id_and_duration] = record
-                sources[potential_sources_id] = record
-                set_potential_decimalal(sources, decimal_duration, record)
-                data_for_update[record["video_id"]] = {
-                    "duration": record["video_duration"],
-                    "originality": True,
-                    "is_potential": False,
-                    "video_duration": record["video_duration"],
-                    "video_duration_round": round(float(record["video_duration"]), 1),
-                    "hash": record["video_hash"]
-                }
-            else:
-                data_for_update[record["video_id"]] = {
-                    "duration": record["video_duration"],
-                    "originality": False,
-                    "is_potential": is_potential,
-                    "source": source_ref["video_id"],
-                    "video_duration": record["video_duration"],
-                    "video_duration_round": round(float(record["video_duration"]), 1),
-                    "hash": record["video_hash"]
-                }
-                sources[hash_] = source_ref
-                sources[audio_id_and_duration] = source_ref
-                sources[potential_sources_id] = source_ref
-                set_potential_decimalal(sources, decimal_duration, source_ref)
-
-        except:
-            logger.error(f"Video {video}, {format_exc()}")
-
-
-    tasks = []
-    for id_, data in data_for_update.items():
-        if data["originality"]:
-            search_reel = f'"{id_}"' + "={Reel ID}"
-            tasks.append(get_record(BASE, IG_Reels, search_reel, data, id_))
-    answer = await asyncio.gather(*tasks)
-    for item in answer:
-        data_for_update[item[0]] = item[1]
-    tasks = []
-    for id_ in data_for_update.keys():
-        data = data_for_update[id_]
-        if not data["originality"] and data["is_potential"]:
-            if data_for_update[data["source"]].get("reel_id", None):
-                search_reel = f'"{id_}"' + "={Reel ID}"
-                tasks.append(get_record(BASE, IG_Reels, search_reel, data, id_))
-    answer = await asyncio.gather(*tasks)
-    for item in answer:
-        data_for_update[item[0]] = item[1]
-    tasks = []
-    for id_ in data_for_update.keys():
-        data = data_for_update[id_]
-        if not data["originality"] and not data["is_potential"]:
-            if data_for_update[data["source"]].get("reel_id", False):
-                search_reel = f'"{id_}"' + "={Reel ID}"
-                tasks.append(get_record(BASE, IG_Reels, search_reel, data, id_))
-    answer = await asyncio.gather(*tasks)
-    for item in answer:
-        data_for_update[item[0]] = item[1]
-    batches = []
-    none_batches = []
-
-    for id_ in data_for_update.keys():
-        data = data_for_update[id_]
-        if data.get("reel_id", None):
-            originality = "Original Content" if data["originality"] else "Duplicate Content"
-            if data["is_potential"]:
-                originality = "Potential Duplicate"
-            update_data = {
-                "id": data["reel_id"],
-                "fields": {
-                    "Link to Original Content": [],
-                    "Duplicate / Original": originality,
-                    "Video hash": data["hash"],
-                    "Reel Duration": data["video_duration"],
-                    "Video rounded duration": data["video_duration_round"]
-                }
-            }
-            link_to_origin = data_for_update.get(data.get("source", None), {}).get("reel_id", None)
-            if link_to_origin and not data["originality"]:
-                update_data["fields"]["Link to Original Content"] = [link_to_origin]
-            batches.append(update_data)
-    batches.sort(key=lambda x: x["fields"]["Duplicate / Original"] == "Original Content")
-
-    return batches
-
-
-def make_users_map(users):
-    user_map = {}
-    for user in users:
-        if "Model" in user["fields"]:
-            if len(user["fields"]["Model"]) == 1:
-                model = user["fields"]["Model"][0]
-                username = user["fields"]["Username"]
-                if model not in user_map:
-                    user_map[model] = []
-                user_map[model].append({
-                    "username": username,
-                    "reels": user["fields"].get("IG Reels", [])
-                })
-    return user_map
-
-
-async def upsert(i, records):
-    try:
-        answer = await airtabel.upsert(BASE, IG_Reels, None, records)
-    except Exception:
-        error_logger.error(f"ERROR IG Reels {EXEC_ID}")
-        error_logger.error(format_exc())
-        logger.error(format_exc())
-        error_logger.error(f"{records}")
-    print(f"End {i}")
-
-
-async def get_records():
-    view = airtabel.local_cache[f"shema_{IG_Accounts}_views"][VIEW]
-    execution_logger.info("Get Users")
-    users = await airtabel.search_until(
-        BASE, IG_Accounts, None, view,
-        ["Username", "Model", "IG Reels"]
-    )
-    stdout.write(f"List len: {len(users['records'])}\n")
-    user_map = make_users_map(users["records"])
-    batches = await get_reels_for(user_map)
-    execution_logger.info("Split them on chunks")
-
-    tasks = []
-    for i, chunk in enumerate(chunks(batches, ONE_BUTCH_SIZE)):
-        tasks.append(upsert(i, chunk))
-    await asyncio.gather(*tasks)
-
-async def main():
-    global _need_ping
-
-    airtabel.load_cache("airtable_db.json")
-    execution_logger.info("Airtable Cache Loaded")
-    await airtabel.init(BASE)
-    execution_logger.info("Airtable Init Finished")
-    airtabel.dump_cache("airtable_db.json")
-    execution_logger.info("Airtable Cache Dumped")
-
-    await get_records()
-    _need_ping = False
+    exit(0)
@@ -2,14 +2,15 @@ import asyncio
 import libs.init
 from asgiref.sync import sync_to_async
 
-from libs.api import AirtableApi, RapidApi, _request_counter
+from libs.api import AirtableApi, RapidApi, older_than, _request_counter
 from libs.settings import AIRTABLE_TOKEN, XRapidAPIHost, XRapidAPIKey
 from libs.utils import chunks
 from datetime import datetime
 from libs.logs import execution_logger, error_logger
 from libs.makepipeline import Step, Const, OUT
-from cache.models import Sound, Reel
-from traceback import format_exc
+from cache.models import Reel
+from cache.sounds import SoundResolver
+from cache.repository import database
 
 const = Const(
     BASE='Instagram',
@@ -32,14 +33,17 @@ rapid = RapidApi(
 )
 
 if __name__ == '__main__':
+    # new sounds are created 10 per request
+    sounds = airtabel.write_queue(const.BASE, const.SOUNDS)
+    sound_resolver = SoundResolver(sounds)
 
-    get_sound_object = sync_to_async(Sound.objects.get, thread_sensitive=True)
     get_reel_object = sync_to_async(Reel.objects.get, thread_sensitive=True)
+    update_or_create_reel = sync_to_async(Reel.objects.update_or_create, thread_sensitive=True)
 
-    async def get_sound(model, const):
+    def parse_sound(model):
         sound = None
-        if model.get("clips_metadata", {}).get("audio_type", "") == "licensed_music":
-            _data = model.get("clips_metadata", {}).get("music_info", {}).get("music_asset_info", None)
+        if (model.get("clips_metadata") or {}).get("audio_type", "") == "licensed_music":
+            _data = ((model.get("clips_metadata") or {}).get("music_info") or {}).get("music_asset_info", None)
             if _data is not None:
                 sound = {
                     "Sound ID": str(_data["audio_id"]),
@@ -47,27 +51,19 @@ if __name__ == '__main__':
                     "Sound Type": "Licensed Music"
                 }
         else:
-            _data = model.get("clips_metadata", {}).get("original_sound_info", None)
+            _data = (model.get("clips_metadata") or {}).get("original_sound_info", None)
             if _data is not None:
                 sound = {
                     "Sound ID": str(_data["audio_id"]),
                     "Sound Title": str(_data["original_audio_title"]),
                     "Sound Type": "Original Sound"
                 }
-        if sound:
-            try:
-                cache_obj = await get_sound_object(rapid_id=sound['Sound ID'])
-            except Exception:
-                error_logger.error(f'{sound["Sound ID"]} ERROR: {format_exc()}')
-                ai_sound = await airtabel.create(const.BASE, const.SOUNDS, sound)
-                sound_id = ai_sound["id"]
-                cache_obj = Sound(
-                    rapid_id=sound['Sound ID'],
-                    airtabel_id=sound_id
-                )
-                await cache_obj.asave()
-            return cache_obj
+        return sound
 
+    async def get_sound(model, const):
+        sound = parse_sound(model)
+        if sound:
+            return await sound_resolver.resolve(sound)
         else:
             error_logger.error(f'Sound not found - {model}')
             return None
@@ -92,7 +88,13 @@ if __name__ == '__main__':
 
     async def _step3(data: dict, context, const, pipe, iteration, step_number) -> list:
         username = data['fields']['Username']
-        answer = await rapid.get_n_page(username, const.URL_MODEL, const.PAGES)
+        stop = None
+        if data["fields"].get("Created"):
+            # without a date every page is loaded, as before the early stop
+            stop = older_than(datetime.strptime(data["fields"]["Created"], "%Y-%m-%d"))
+        answer = await rapid.get_n_page(
+            username, const.URL_MODEL, const.PAGES, stop=stop
+        )
         models = answer.get('answer', [])
         models.sort(key=lambda item: -item['taken_at'])
         return {'models': models, 'user': data, 'status': answer.get('status')}
@@ -127,6 +129,10 @@ if __name__ == '__main__':
         for items in data:
             _data += items
         execution_logger.info(f"Total: {len(_data)}")
+        # every sound of the run in one query, step 6 reads them from memory
+        await sound_resolver.prefetch([
+            sound['Sound ID'] for sound in map(parse_sound, _data) if sound
+        ])
         return _data
 
     async def _step6(data: dict, context, const, pipe, iteration, step_number) -> list:
@@ -181,22 +187,23 @@ if __name__ == '__main__':
                 try:
                     await get_reel_object(airtabel_id=airtabel_id)
                 except Exception:
-                    reel = Reel(airtabel_id=airtabel_id, rapid_id=rapid_id)
-                    await reel.asave()
+                    # a row detached by cache_maker gets its record back
+                    await update_or_create_reel(rapid_id=rapid_id, defaults={'airtabel_id': airtabel_id})
 
         return answer
 
-    async def _step9(data: dict, context, const, pipe, iteration, step_number) -> list:
-        data = []
-        for item in context[3]['out']:
-            data.append({
+    async def _step9(data: list, context, const, pipe, iteration, step_number) -> list:
+        # gets the output of step 3, runs next to the content branch
+        update = []
+        for item in data:
+            update.append({
                 'id': item['user']['id'],
                 'fields': {
                     "Status": item['status'],
                     "Reels - Last Scraped": datetime.today().strftime("%Y-%m-%d")
                 }
             })
-        return list(chunks(data, 10))
+        return list(chunks(update, 10))
 
     async def _step10(data: dict, context, const, pipe, iteration, step_number) -> dict:
         answer = await airtabel.upsert(
@@ -211,10 +218,10 @@ if __name__ == '__main__':
     step3 = Step(_step3, name='step_3', const=const, isloop='aloop', mapper='records')
     step4 = Step(_step4, name='step_4', const=const, isloop='aloop')
     step5 = Step(_step5, name='step_5', const=const)
-    step6 = Step(_step6, name='step_6', const=const, isloop='aloop')
+    step6 = Step(_step6, name='step_6', const=const, isloop='aloop', concurrency=50)
     step7 = Step(_step7, name='step_7', const=const)
     step8 = Step(_step8, name='step_8', const=const, isloop='aloop')
-    step9 = Step(_step9, name='step_9', const=const)
+    step9 = Step(_step9, name='step_9', const=const, after=['step_3'])
     step10 = Step(_step10, name='step_10', const=const, isloop='aloop')
 
     pipe = step1 > step2
@@ -238,5 +245,6 @@ if __name__ == '__main__':
         self.write_status(self.get_status())
 
     pipe.set_time_handler(time_handler)
+    pipe.on_shutdown(database.close)
 
     asyncio.run(pipe.run_with_timer("Instagram Reels"))
@@ -1,11 +1,14 @@
 import asyncio
+import libs.init
 
-from libs.api import AirtableApi, RapidApi, Loader, _request_counter
+from libs.api import AirtableApi, RapidApi, older_than, Loader, _request_counter
 from libs.settings import AIRTABLE_TOKEN, XRapidAPIHost, XRapidAPIKey
 from libs.utils import chunks
 from datetime import datetime
 from libs.logs import execution_logger, error_logger
 from libs.makepipeline import Step, Const, OUT
+from cache.mirror import AirtableMirror
+from cache.hashes import MediaHashCache
 
 const = Const(
     BASE='Instagram',
@@ -27,7 +30,11 @@ rapid = RapidApi(
     {"X-RapidAPI-Key": XRapidAPIKey, "X-RapidAPI-Host": XRapidAPIHost}
 )
 
-L = Loader()
+L = Loader(hash_cache=MediaHashCache())
+# Hash -> original record lookups are answered from the local mirror
+hashes = AirtableMirror(
+    airtabel, const.BASE, const.MODEL, ["Hash", "Duplicate / Original"]
+)
 
 if __name__ == '__main__':
 
@@ -52,6 +59,7 @@ if __name__ == '__main__':
         airtabel.load_cache("airtable_db.json")
         await airtabel.init(const.BASE)
         airtabel.dump_cache("airtable_db.json")
+        await hashes.sync()
 
     async def _step2(data: None, context, const, pipe, iteration, step_number) -> dict:
         if const.USER_COUNT is not None:
@@ -68,7 +76,13 @@ if __name__ == '__main__':
 
     async def _step3(data: dict, context, const, pipe, iteration, step_number) -> list:
         username = data['fields']['Username']
-        answer = await rapid.get_n_page(username, const.URL_MODEL, const.PAGES)
+        stop = None
+        if data["fields"].get("Created"):
+            # without a date every page is loaded, as before the early stop
+            stop = older_than(datetime.strptime(data["fields"]["Created"], "%Y-%m-%d"))
+        answer = await rapid.get_n_page(
+            username, const.URL_MODEL, const.PAGES, stop=stop
+        )
         models = answer.get('answer', [])
         models.sort(key=lambda item: -item['taken_at'])
         return {'models': models, 'user': data, 'status': answer.get('status')}
@@ -169,12 +183,9 @@ if __name__ == '__main__':
         post = data
 
         hash_, media = await get_hash(post)
-        hash_find = f'"{hash_}"' + "={Hash}"
-        is_origin = '"Original Content"={Duplicate / Original}'
-        hash_find = f'AND({hash_find}, {is_origin})'
-        origin_post = await airtabel.search_by_formula(
-            const.BASE, const.MODEL, hash_find
-        )
+        origin_post = await hashes.lookup({
+            "Hash": hash_, "Duplicate / Original": "Original Content"
+        })
         origin = "Original Content"
         if origin_post:
             origin = "Duplicate Content"
@@ -219,17 +230,18 @@ if __name__ == '__main__':
             create += len(part['createdRecords'])
         execution_logger.info(f"Created: {create} Updated: {update}")
 
-    async def _step11(data: dict, context, const, pipe, iteration, step_number) -> list:
-        data = []
-        for item in context[3]['out']:
-            data.append({
+    async def _step11(data: list, context, const, pipe, iteration, step_number) -> list:
+        # gets the output of step 3, runs next to the content branch
+        update = []
+        for item in data:
+            update.append({
                 'id': item['user']['id'],
                 'fields': {
                     "Status": item['status'],
                     "Stories - Last Scraped": datetime.today().strftime("%Y-%m-%d")
                 }
             })
-        return list(chunks(data, 10))
+        return list(chunks(update, 10))
 
     async def _step12(data: dict, context, const, pipe, iteration, step_number) -> dict:
         answer = await airtabel.upsert(
@@ -245,11 +257,11 @@ if __name__ == '__main__':
     step4 = Step(_step4, name='step_4', const=const, isloop='aloop')
     step5 = Step(_step5, name='step_5', const=const, isloop='aloop')
     step6 = Step(_step6, name='step_6', const=const)
-    step7 = Step(_step7, name='step_7', const=const, isloop='aloop')
+    step7 = Step(_step7, name='step_7', const=const, isloop='aloop', concurrency=50)
     step8 = Step(_step8, name='step_8', const=const)
     step9 = Step(_step9, name='step_9', const=const, isloop='aloop')
     step10 = Step(_step10, name='step_10', const=const)
-    step11 = Step(_step11, name='step_11', const=const)
+    step11 = Step(_step11, name='step_11', const=const, after=['step_3'])
     step12 = Step(_step12, name='step_12', const=const, isloop='aloop')
 
     pipe = step1 > step2
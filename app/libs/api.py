@@ -1,34 +1,46 @@
-import aiohttp
 import asyncio
 from asyncio import Lock
-from libs.utils import rate_limit, repeat_when_429_or_5xx
+from libs.utils import repeat_when_429_or_5xx
 from json import dump, load, loads, dumps
 from pathlib import Path
 from uuid import uuid4
 import time
-from anyio import open_file
-from libs.logs import EXEC_ID, request_logger
+from libs.logs import request_logger
 from sys import stdout
 from hashlib import sha256
 from traceback import format_exc
-from libs.dirs import REQUEST_DIR
+from libs.session import session_pool
+from libs.archive import request_archive
+from libs.limiter import Limiter
+from libs.writequeue import AirtableWriteQueue, write_queues
+from libs.executor import offload
 import re
-from urllib.parse import unquote, urlparse
+from urllib.parse import unquote
 
 
-REQUEST_DIR = REQUEST_DIR / str(EXEC_ID)
-if not REQUEST_DIR.is_dir():
-    REQUEST_DIR.mkdir()
-
 _request_counter = {
     "planned": 0,
     "started": 0,
     "ended": 0,
 
-    "max_active_requests": 10,
-    "stop": False
+    "max_active_requests": 10
 }
 
+limiter = Limiter(_request_counter)
+# burst 1: any 1s window sees at most rate + 1 calls
+# 10 requests per second for every Rapid API
+limiter.configure("rapid", 9, 1)
+limiter.configure("rapid_twitter", 9, 1)
+limiter.configure("rapid_tiktok", 9, 1)
+# 5 requests per second per Airtable base (30s lockout above it)
+limiter.configure("airtable", 4, 1)
+limiter.configure("loader", 5, 1, concurrency=10)
+limiter.configure("simple_get", 10, 1, concurrency=10)
+
+
+def airtable_base(self, method, url, *args, **kwargs):
+    return url.split('/')[0]
+
 
 class BaseApi():
     r_lock = asyncio.Lock()
@@ -63,10 +75,8 @@ class BaseApi():
             "Content-Type": "application/json"
         }
 
-    # base request
-    # @rate_limit(0.1, "global_requests", asyncio.Lock())
-    @repeat_when_429_or_5xx
-    async def _request(self, method, url, headers=None, json=None, params=None):
+    # base request, one attempt -> (body, status, headers)
+    async def _send(self, method, url, headers=None, json=None, params=None):
         if headers is None:
             headers = self.headers
         if json is not None:
@@ -75,36 +85,31 @@ class BaseApi():
         _id = uuid4()
 
         _request_counter["started"] += 1
-        async with aiohttp.ClientSession() as session:
-            start = time.monotonic()
-            async with session.request(
-                method, f"{self.base_url}{url}", json=json, headers=headers, params=params
-            ) as response:
-                duration = round(time.monotonic()-start, 3)
-                if duration > 35:
-                    _request_counter["stop"] = True
-                async with await open_file(REQUEST_DIR / f"{_id}.req", "w") as file:
-                    await file.write(await response.text())
-                if self.show_tooltips:
-
-                    request_logger.info(f"{method} {self.base_url}{url} {response.status} {duration} {_id}")
-                content_type = response.headers.get("Content-Type")
-                if response.status != 200:
-                    if response.status != 429:
-                        request_logger.error(f"{await response.text()}")
-                # if response.status == 404:
-                #     return ({}, response.status)
-                # if (response.status >= 500 or response.status == 429) and repeat <= 5:
-                #     return await self._request(
-                #         method, url, headers, json, params, repeat+1
-                #     )
-                if "application/json" in content_type:
-                    _request_counter["ended"] += 1
-                    return (await response.json(), response.status)
-                else:
-                    _request_counter["ended"] += 1
-                    return (await response.text(), response.status)
-        return ({}, 500)
+        start = time.monotonic()
+        async with session_pool.request(
+            method, f"{self.base_url}{url}", json=json, headers=headers, params=params
+        ) as response:
+            text = await response.text()
+            duration = round(time.monotonic()-start, 3)
+            request_archive.record(_id, {
+                'method': method, 'url': f"{self.base_url}{url}",
+                'params': params, 'status': response.status,
+                'duration': duration
+            }, text, is_error=response.status != 200)
+            if self.show_tooltips:
+
+                request_logger.info(f"{method} {self.base_url}{url} {response.status} {duration} {_id}")
+            content_type = response.headers.get("Content-Type") or ""
+            if response.status != 200:
+                if response.status != 429:
+                    request_logger.error(f"{text}")
+            _request_counter["ended"] += 1
+            if "application/json" in content_type:
+                return (loads(text), response.status, response.headers)
+            else:
+                return (text, response.status, response.headers)
+
+    _request = repeat_when_429_or_5xx(_send)
 
 
 class RapidApi(BaseApi):
@@ -113,8 +118,7 @@ class RapidApi(BaseApi):
     def headers(self):
         return self.token
 
-    # 10 requests per second
-    _request = rate_limit(0.1, "rapid", asyncio.Lock(), _request_counter)(BaseApi._request)
+    _request = repeat_when_429_or_5xx(limiter.limit("rapid")(BaseApi._send))
 
     async def info(self, user, id_=None):
         # v1
@@ -170,33 +174,56 @@ class RapidApi(BaseApi):
             return {"answer": {}, "id_": id_}
         return {"answer": answer[0], "id_": id_}
 
-    async def get_n_page(self, user, model, page_number=7, id_=None, callback=None):
-        request_logger.debug(f"RapidApi get_n_page {user}/{model}")
+    async def iter_pages(self, user, model, page_number=7, id_=None, stop=None):
+        # Yields raw pages as they arrive. The next page is requested before
+        # the current one is handed out, so the caller's parsing overlaps the
+        # round-trip. stop(items) -> True ends paging after this page.
         func = getattr(self, model)
-        request_logger.debug(f"RapidApi get_n_page {user}/{model} get 1 page")
-        answer = await func(user, id_)
+        request_logger.debug(f"RapidApi iter_pages {user}/{model} get 1 page")
+        answer = (await func(user, id_))["answer"]
+        page = 1
+        while True:
+            items = answer.get("data", {}).get("items") if "data" in answer else None
+            token = answer.get("pagination_token", None)
+            next_page = None
+            if token is not None and page < page_number and not (items and stop is not None and stop(items)):
+                request_logger.debug(f"RapidApi iter_pages {user}/{model} get {page+1} page")
+                next_page = asyncio.create_task(func(user, id_, token))
+            try:
+                yield answer
+            except BaseException:
+                # consumer stopped early, don't leave the prefetch running
+                if next_page is not None:
+                    next_page.cancel()
+                raise
+            if next_page is None:
+                return
+            answer = (await next_page)["answer"]
+            if "data" in answer and "items" in answer.get("data", {}):
+                page += 1
+
+    async def get_n_page(self, user, model, page_number=7, id_=None, callback=None, stop=None):
+        request_logger.debug(f"RapidApi get_n_page {user}/{model}")
+        records = None
+        status = None
+        update_status = None
+        async for answer in self.iter_pages(user, model, page_number, id_, stop):
+            if status is None:
+                if "data" in answer:
+                    status = "Active"
+                else:
+                    status = "Potential Ban"
 
-        answer = answer["answer"]
-        if "data" in answer:
-            status = "Active"
-        else:
-            status = "Potential Ban"
+                if callback is not None:
+                    callback = callback(status)
+                    update_status = await callback(id_)
 
-        update_status = None
-        if callback is not None:
-            callback = callback(status)
-            update_status = await callback(id_)
-
-        if "data" in answer and "items" in answer.get("data", {}):
-            records = answer["data"]["items"]
-            page = 1
-            while answer.get("pagination_token", None) is not None and page < page_number:
-                request_logger.debug(f"RapidApi get_n_page {user}/{model} get {page+1} page")
-                answer = await func(user, id_, answer.get("pagination_token"))
-                answer = answer["answer"]
                 if "data" in answer and "items" in answer.get("data", {}):
-                    records += answer["data"]["items"]
-                    page += 1
+                    records = []
+            if records is not None and "data" in answer and "items" in answer.get("data", {}):
+                records += answer["data"]["items"]
+
+        if records is not None:
             return {
                 "answer": records, "id_": id_, "update_status": update_status,
                 'status': status
@@ -208,6 +235,17 @@ class RapidApi(BaseApi):
             }
 
 
+def older_than(created, key="taken_at"):
+    # stop predicate for iter_pages/get_n_page: the page already reaches
+    # posts older than `created` (pinned posts don't count)
+    limit = created.timestamp()
+
+    def stop(items):
+        dates = [item.get(key, 0) for item in items if not item.get("is_pinned", False)]
+        return bool(dates) and min(dates) < limit
+    return stop
+
+
 class AirtableApi(BaseApi):
     lock = Lock()
 
@@ -217,8 +255,10 @@ class AirtableApi(BaseApi):
             "Authorization": f"Bearer {self.token}"
         }
 
-    # 5 requests per second
-    _request = rate_limit(0.25, "airtable", asyncio.Lock(), _request_counter)(BaseApi._request)
+    # a 429 locks the base out for 30s, retrying sooner only extends it
+    _request = repeat_when_429_or_5xx(
+        limiter.limit("airtable", airtable_base)(BaseApi._send), lockout=31, key=airtable_base
+    )
 
     # meta info
     async def _bases(self):
@@ -314,12 +354,81 @@ class AirtableApi(BaseApi):
             reel_id = None
         return reel_id
 
-    async def search_until(self, baseName, tableName, maxRecords=None, view=None, fields=None, filterByFormula=None):
+    async def iter_search(self, baseName, tableName, maxRecords=None, view=None, fields=None, filterByFormula=None):
+        # Yields record pages as they arrive. The next page is requested
+        # before the current one is handed out.
         answer = await self.search(baseName, tableName, maxRecords, view, fields, filterByFormula)
-        records = answer["records"]
-        while "offset" in answer:
-            answer = await self.search(baseName, tableName, maxRecords, view, fields, filterByFormula, answer["offset"])
-            records += answer["records"]
+        while True:
+            next_page = None
+            if "offset" in answer:
+                next_page = asyncio.create_task(self.search(
+                    baseName, tableName, maxRecords, view, fields, filterByFormula, answer["offset"]
+                ))
+            try:
+                yield answer["records"]
+            except BaseException:
+                if next_page is not None:
+                    next_page.cancel()
+                raise
+            if next_page is None:
+                return
+            answer = await next_page
+
+    @staticmethod
+    def created_time_partitions(start, end, parts):
+        # Formulas that split CREATED_TIME() into `parts` equal buckets between
+        # start and end (datetimes). The first and the last bucket are open,
+        # so records outside [start, end) are not lost.
+        step = (end - start) / parts
+        bounds = [(start + step * i).strftime('%Y-%m-%dT%H:%M:%S.000Z') for i in range(1, parts)]
+        formulas = []
+        for i in range(parts):
+            conditions = []
+            if i > 0:
+                conditions.append(f"NOT(IS_BEFORE(CREATED_TIME(), '{bounds[i - 1]}'))")
+            if i < parts - 1:
+                conditions.append(f"IS_BEFORE(CREATED_TIME(), '{bounds[i]}')")
+            formulas.append(f"AND({', '.join(conditions)})" if conditions else "TRUE()")
+        return formulas
+
+    async def iter_partitions(self, baseName, tableName, partitions, view=None, fields=None, filterByFormula=None):
+        # Pulls every partition (a formula) concurrently and yields pages in
+        # arrival order. The per-base limiter keeps the total under 5 rps.
+        queue = asyncio.Queue(maxsize=len(partitions) * 2)
+
+        async def worker(formula):
+            if filterByFormula is not None:
+                formula = f"AND({filterByFormula}, {formula})"
+            try:
+                async for records in self.iter_search(baseName, tableName, None, view, fields, formula):
+                    await queue.put(records)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await queue.put(None)
+                raise
+            await queue.put(None)
+
+        tasks = [asyncio.create_task(worker(formula)) for formula in partitions]
+        try:
+            running = len(tasks)
+            while running:
+                records = await queue.get()
+                if records is None:
+                    running -= 1
+                else:
+                    yield records
+            for task in tasks:
+                # re-raise errors of the workers
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def search_until(self, baseName, tableName, maxRecords=None, view=None, fields=None, filterByFormula=None):
+        records = []
+        async for page in self.iter_search(baseName, tableName, maxRecords, view, fields, filterByFormula):
+            records += page
         return {"records": records}
 
     async def update(self, baseName, tableName, recordId, fields):
@@ -357,6 +466,21 @@ class AirtableApi(BaseApi):
         })
         return answer[0]
 
+    async def create_batch(self, baseName, tableName, records):
+        base = self.local_cache['bases'][baseName]
+        table = self.local_cache['shema'][tableName]
+        request_logger.debug(f"Airtable create {baseName}/{tableName} {len(records)} records")
+        answer = await self._request("post", f"{base}/{table}", json={
+            "records": records
+        })
+        return answer[0]
+
+    def write_queue(self, baseName, tableName, mergeFields=None, size=10, delay=1.0):
+        # batched, coalescing writes, flushed at the end of Pipeline.run
+        queue = AirtableWriteQueue(self, baseName, tableName, mergeFields, size, delay)
+        write_queues.append(queue)
+        return queue
+
     async def get(self, baseName, tableName, recordId):
         base = self.local_cache['bases'][baseName]
         table = self.local_cache['shema'][tableName]
@@ -370,7 +494,7 @@ class RapidTwitterApi(BaseApi):
     def headers(self):
         return self.token
 
-    _request = rate_limit(0.1, "rapid", asyncio.Lock(), _request_counter)(BaseApi._request)
+    _request = repeat_when_429_or_5xx(limiter.limit("rapid_twitter")(BaseApi._send))
 
     async def followingids(self, username, count=50):
         data = {"username": username, 'count': count}
@@ -406,7 +530,7 @@ class RapidTikTokApi(BaseApi):
     def headers(self):
         return self.token
 
-    _request = rate_limit(0.1, "rapid", asyncio.Lock(), _request_counter)(BaseApi._request)
+    _request = repeat_when_429_or_5xx(limiter.limit("rapid_tiktok")(BaseApi._send))
 
     async def user_posts(self, user, pagination_token=None, count=20):
         data = {"user_id": user, 'count': count}
@@ -419,23 +543,39 @@ class RapidTikTokApi(BaseApi):
             return None
         return answer[0]
 
-    async def get_n_page(self, user, count=20, n=1):
+    @staticmethod
+    def is_pinned(item):
+        return str(item.get('is_top', None)) == '1'
+
+    async def iter_posts(self, user, count=20, since=None, last_seen=None):
+        # Cursor iterator over user-posts, newest first, 20 per page.
+        # since - unix time, last_seen - aweme_id from the previous run: once a
+        # page reaches either of them the next page is never requested.
+        pages = max(1, count // 20)
+        cursor = None
+        for page in range(pages):
+            answer = await self.user_posts(user, count=20, pagination_token=cursor)
+            if not answer:
+                return
+            items = answer.get('aweme_list', None) or []
+            yield items
+
+            posts = [item for item in items if not self.is_pinned(item)]
+            if since is not None and any(item.get('create_time', 0) < since for item in posts):
+                return
+            if last_seen is not None and any(item.get('aweme_id') == last_seen for item in posts):
+                return
+            if answer.get('has_more', 1) in [0, False]:
+                return
+            next_ = answer.get('max_cursor', None)
+            if next_ is None or next_ == cursor:
+                return
+            cursor = next_
+
+    async def get_n_page(self, user, count=20, n=1, since=None, last_seen=None):
         answer = {"aweme_list": []}
-        page_1 = await self.user_posts(user, count=20)
-        if 'aweme_list' in page_1 and page_1['aweme_list'] is not None:
-            answer['aweme_list'] += page_1['aweme_list']
-        c = 2
-        mc = count // 20
-        next_ = None
-        if 'max_cursor' in page_1:
-            next_ = page_1['max_cursor']
-        while c <= mc and next_ is not None:
-            page_1 = await self.user_posts(user, count=20, pagination_token=next_)
-            if 'aweme_list' in page_1 and page_1['aweme_list'] is not None:
-                answer['aweme_list'] += page_1['aweme_list']
-            if 'max_cursor' in page_1:
-                next_ = page_1['max_cursor']
-            c += 1
+        async for items in self.iter_posts(user, count, since, last_seen):
+            answer['aweme_list'] += items
         return answer
 
     async def get_user(self, username):
@@ -451,56 +591,151 @@ class RapidTikTokApi(BaseApi):
 class Loader():
     total_bytes = 0
 
-    @rate_limit(0.2, "loader", asyncio.Lock(), _request_counter)
+    # partial=N - fingerprint from the first and last N bytes plus the size
+    # (two Range requests) instead of the whole file. Fingerprints look like
+    # "<size>:<sha256>" and never equal a full hash.
+    # hash_cache - cache.hashes.MediaHashCache or any object with the same
+    # async get/set, asked before anything is downloaded.
+    # load_hash(path=...) also writes the whole file there, for work on the
+    # bytes themselves (keyframes) without a second download.
+    def __init__(self, partial=None, chunk_size=1024 ** 2, hash_cache=None):
+        self.partial = partial
+        self.chunk_size = chunk_size
+        self.hash_cache = hash_cache
+
+    @limiter.limit("loader")
     async def load(self, url, name):
         print(f"Start download {url}")
-        async with aiohttp.ClientSession() as session:
-            async with session.request("get", url) as response:
-                data = await response.read()
-                print(f"End download {url}")
-                with open(f"{name}.mp4", "bw") as f:
-                    f.write(data)
-                hash_ = sha256(data).hexdigest()
-                del data
-                return hash_
-
-    @rate_limit(0.1, "simple_get", asyncio.Lock(), _request_counter)
+        async with session_pool.request("get", url) as response:
+            data = await response.read()
+            print(f"End download {url}")
+            with open(f"{name}.mp4", "bw") as f:
+                f.write(data)
+            hash_ = sha256(data).hexdigest()
+            del data
+            return hash_
+
+    @limiter.limit("simple_get")
     async def simple_get(self, url, id_=None):
         _id = uuid4()
         _request_counter['started'] += 1
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.request("get", url) as response:
-                    if response.status == 200:
-                        text = await response.text()
-                        # async with await open_file(REQUEST_DIR / f"{_id}.req", "w") as file:
-                        #     await file.write(f'{url} - {id_}\n{text}')
-                        _request_counter['ended'] += 1
-                        return text
+            async with session_pool.request("get", url) as response:
+                if response.status == 200:
+                    text = await response.text()
+                    # async with await open_file(REQUEST_DIR / f"{_id}.req", "w") as file:
+                    #     await file.write(f'{url} - {id_}\n{text}')
+                    _request_counter['ended'] += 1
+                    return text
         except Exception:
             request_logger.error(f'{url} {id_}\n{format_exc()}')
         _request_counter['ended'] += 1
         return None
 
-    @rate_limit(0.2, "loader", asyncio.Lock(), _request_counter)
-    async def load_hash(self, url, r=0):
-        print(f"Start download {url}")
-        if r >= 4:
-            return "UNDEFINED HASH"
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.request("get", url) as response:
-                    data = await response.read()
-                    print(f"End download {url}")
-                    self.total_bytes += len(data)
-                    hash_ = sha256(data).hexdigest()
-                    del data
-                    return hash_
-        except Exception:
-            request_logger.error(f"Download {url} filed!")
-            request_logger.error(f"{format_exc()}")
-            await asyncio.sleep(5)
-            await self.load_hash(url, r + 1)
+    async def load_hash(self, url, retries=4, media_id=None, duration=0, path=None):
+        # media_id must name the file (see cache.models.MediaHash). With a
+        # path the cache is not asked, the file is needed.
+        partial = self.partial or 0
+        if self.hash_cache is not None and path is None:
+            hash_ = await self.hash_cache.get(url, media_id, partial)
+            if hash_ is not None:
+                return hash_
+        hash_, size = await self.download_hash(url, retries, path)
+        if self.hash_cache is not None and size is not None:
+            await self.hash_cache.set(url, hash_, size, media_id, partial, duration)
+        return hash_
+
+    @limiter.limit("loader")
+    async def download_hash(self, url, retries=4, path=None):
+        # retry inside the limiter slot, re-entering it could deadlock
+        for r in range(retries):
+            print(f"Start download {url}")
+            try:
+                if self.partial and path is None:
+                    answer = await self.fingerprint(url, self.partial)
+                    if answer is not None:
+                        return answer
+                return await self.stream_hash(url, path)
+            except Exception:
+                request_logger.error(f"Download {url} filed!")
+                request_logger.error(f"{format_exc()}")
+                await asyncio.sleep(5)
+        return "UNDEFINED HASH", None
+
+    async def stream_hash(self, url, path=None):
+        async with session_pool.request("get", url) as response:
+            if path is None:
+                return await self.hash_response(url, response)
+            with open(path, "wb") as file:
+                return await self.hash_response(url, response, file)
+
+    async def hash_response(self, url, response, file=None):
+        # At most chunk_size bytes of the file are in memory. sha256 releases
+        # the GIL on big buffers, so full chunks are hashed in a thread.
+        # Every body is read to the end: a keep-alive connection handed back
+        # with unread data can hang the next request on it.
+        if not 200 <= response.status < 300:
+            # an error page must not be hashed (and cached) as the media
+            await response.read()
+            raise Exception(f"Download {url} answered {response.status}")
+        hasher = sha256()
+        buffer = bytearray()
+        loaded = 0
+        async for chunk in response.content.iter_chunked(self.chunk_size):
+            loaded += len(chunk)
+            buffer += chunk
+            if len(buffer) >= self.chunk_size:
+                await offload('thread', consume, hasher, file, bytes(buffer))
+                buffer.clear()
+        consume(hasher, file, buffer)
+        print(f"End download {url}")
+        self.total_bytes += loaded
+        return hasher.hexdigest(), loaded
+
+    async def fingerprint(self, url, size):
+        # A server that ignores Range answers 200 with the whole file, it is
+        # hashed in full. None on a 206 that can't be used, the caller
+        # hashes everything.
+        hasher = sha256()
+        async with session_pool.request("get", url, headers={"Range": f"bytes=0-{size - 1}"}) as response:
+            if response.status != 206:
+                return await self.hash_response(url, response)
+            total = response.headers.get("Content-Range", "").split("/")[-1]
+            head = await response.read()
+        if not total.isdigit():
+            return None
+        total = int(total)
+        self.total_bytes += len(head)
+        hasher.update(head)
+        if total > size:
+            start = max(size, total - size)
+            async with session_pool.request("get", url, headers={"Range": f"bytes={start}-"}) as response:
+                if response.status != 206:
+                    return await self.hash_response(url, response)
+                content_range = response.headers.get("Content-Range", "")
+                tail = await response.read()
+            if not content_range.startswith(f"bytes {start}-"):
+                return None
+            self.total_bytes += len(tail)
+            hasher.update(tail)
+        print(f"End download {url}")
+        return f"{total}:{hasher.hexdigest()}", total
+
+
+def consume(hasher, file, data):
+    hasher.update(data)
+    if file is not None:
+        file.write(data)
+
+
+def find_links(patterns, data):
+    of = False
+    answer = re.findall(patterns[0], data, flags=re.IGNORECASE)
+    if not answer:
+        answer = re.findall(patterns[1], data, flags=re.IGNORECASE)
+    else:
+        of = True
+    return answer, of
 
 
 class LinkAnalizer:
@@ -619,13 +854,11 @@ class LinkAnalizer:
         return data
 
     def find(self, data):
-        of = False
-        answer = re.findall(self.state['_patterns'][0], data, flags=re.IGNORECASE)
-        if not answer:
-            answer = re.findall(self.state['_patterns'][1], data, flags=re.IGNORECASE)
-        else:
-            of = True
-        return answer, of
+        return find_links(self.state['_patterns'], data)
+
+    async def find_in_page(self, data):
+        # whole pages are scanned in the process pool
+        return await offload('process', find_links, self.state['_patterns'], data)
 
     async def analize(self, link, depth=0):
         send = False
@@ -674,7 +907,7 @@ class LinkAnalizer:
                 if link not in self.cache:
                     self.cache[link] = ([], False, send)
                 return [], False, send
-            answer, of = self.find(unquote(data))
+            answer, of = await self.find_in_page(unquote(data))
             if of:
                 self.state[domain]['success'] += 1
                 if link not in self.cache:
@@ -0,0 +1,123 @@
+import asyncio
+import gzip
+import random
+from json import dumps, loads
+from pathlib import Path
+from traceback import format_exc
+from libs.dirs import REQUEST_DIR
+from libs.logs import EXEC_ID, error_logger
+from libs.settings import REQUEST_ARCHIVE
+
+
+class RequestArchive:
+    # Append-only archive of raw responses. Every record is its own gzip
+    # member inside segment-<n>.gz, index.jsonl maps request id -> segment,
+    # offset and length so one record can be read back without unpacking the
+    # whole segment. Writing happens on a background task in a thread, the
+    # request path only puts the record on a queue.
+    #
+    # sample: 'all', 'errors', 'off' or a fraction like '0.01'
+    # (errors are always kept when sampling by fraction)
+    def __init__(self, directory, sample='all', segment_size=64 * 1024 ** 2, level=6):
+        self.directory = Path(directory)
+        self.sample = sample
+        self.segment_size = segment_size
+        self.level = level
+        self.segment = 0
+        self.queue = None
+        self.task = None
+        self.written = 0
+        self.dropped = 0
+
+        self.rate = None
+        if sample not in ['all', 'errors', 'off']:
+            self.rate = float(sample)
+
+    def keep(self, is_error):
+        if self.sample == 'off':
+            return False
+        if self.sample == 'all' or is_error:
+            return True
+        if self.sample == 'errors':
+            return False
+        return random.random() < self.rate
+
+    def segment_path(self, segment):
+        return self.directory / f'segment-{segment:05d}.gz'
+
+    def record(self, id_, meta, body, is_error=False):
+        if not self.keep(is_error):
+            self.dropped += 1
+            return
+        if self.task is None:
+            if not self.directory.is_dir():
+                self.directory.mkdir()
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self.writer())
+        self.queue.put_nowait((str(id_), meta, body))
+
+    async def writer(self):
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            stop = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if batch:
+                try:
+                    await asyncio.to_thread(self.write_batch, batch)
+                except Exception:
+                    error_logger.error(f'Request archive write failed\n{format_exc()}')
+            if stop:
+                return
+
+    def write_batch(self, batch):
+        index = []
+        path = self.segment_path(self.segment)
+        with open(path, 'ab') as segment:
+            for id_, meta, body in batch:
+                blob = gzip.compress(
+                    dumps({'id': id_, **meta, 'body': body}).encode(),
+                    compresslevel=self.level
+                )
+                offset = segment.tell()
+                segment.write(blob)
+                index.append(dumps({
+                    'id': id_, 'segment': path.name,
+                    'offset': offset, 'length': len(blob)
+                }))
+            size = segment.tell()
+        with open(self.directory / 'index.jsonl', 'a') as file:
+            file.write('\n'.join(index) + '\n')
+        self.written += len(batch)
+        if size >= self.segment_size:
+            self.segment += 1
+
+    async def close(self):
+        if self.task is not None:
+            self.queue.put_nowait(None)
+            await self.task
+            self.task = None
+
+    @staticmethod
+    def lookup(directory, id_):
+        directory = Path(directory)
+        index = directory / 'index.jsonl'
+        if index.is_file():
+            with open(index) as file:
+                for line in file:
+                    if f'"{id_}"' not in line:
+                        continue
+                    item = loads(line)
+                    if item['id'] == id_:
+                        with open(directory / item['segment'], 'rb') as segment:
+                            segment.seek(item['offset'])
+                            blob = segment.read(item['length'])
+                        return loads(gzip.decompress(blob))
+        # executions made before the archive kept one file per request
+        legacy = directory / f'{id_}.req'
+        if legacy.is_file():
+            return {'id': id_, 'body': legacy.read_text()}
+
+
+request_archive = RequestArchive(REQUEST_DIR / str(EXEC_ID), REQUEST_ARCHIVE)
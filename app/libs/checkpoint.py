@@ -0,0 +1,209 @@
+import gzip
+from json import dumps, loads
+
+INDENT = 4
+
+
+class JsonCheckpoint:
+    # Old format: <step>.json with {"in": ..., "out": ...} and indent=4.
+    # Kept to read executions made before JsonlCheckpoint.
+    def path(self, directory, name):
+        return directory / f'{name}.json'
+
+    def exists(self, directory, name):
+        return self.path(directory, name).is_file()
+
+    def write(self, directory, name, parts, refs=None):
+        self.path(directory, name).write_text(dumps(parts, indent=INDENT))
+
+    def read(self, directory, name, key):
+        return loads(self.path(directory, name).read_text()).get(key)
+
+    def iter(self, directory, name, key):
+        yield from self.read(directory, name, key) or []
+
+
+class JsonlCheckpoint:
+    # <step>.<part>.jsonl.gz for every part ("in", "out"). The first line is
+    # a header: {"list": true} - one item per line follows, {"list": false}
+    # - one line with the value, {"ref": "<step>"} - same data as the "out"
+    # of that step (the "in" of a step is usually the "out" of the previous
+    # one, it is not written twice).
+    def __init__(self, level=1):
+        self.level = level
+
+    def path(self, directory, name, key):
+        return directory / f'{name}.{key}.jsonl.gz'
+
+    def exists(self, directory, name):
+        return any(self.path(directory, name, key).is_file() for key in ['in', 'out'])
+
+    def write(self, directory, name, parts, refs=None):
+        refs = refs or {}
+        for key, value in parts.items():
+            path = self.path(directory, name, key)
+            temp = path.with_suffix('.tmp')
+            with gzip.open(temp, 'wt', compresslevel=self.level) as file:
+                if key in refs:
+                    file.write(dumps({'ref': refs[key]}) + '\n')
+                elif isinstance(value, (list, tuple)):
+                    file.write('{"list": true}\n')
+                    for item in value:
+                        file.write(dumps(item) + '\n')
+                else:
+                    file.write('{"list": false}\n')
+                    file.write(dumps(value) + '\n')
+            temp.replace(path)
+
+    def iter(self, directory, name, key):
+        path = self.path(directory, name, key)
+        if not path.is_file():
+            return
+        with gzip.open(path, 'rt') as file:
+            header = loads(file.readline())
+            if 'ref' in header:
+                yield from self.iter(directory, header['ref'], 'out')
+            elif header['list']:
+                for line in file:
+                    yield loads(line)
+            else:
+                value = loads(file.readline())
+                if isinstance(value, list):
+                    yield from value
+                else:
+                    yield value
+
+    def read(self, directory, name, key):
+        path = self.path(directory, name, key)
+        if not path.is_file():
+            return None
+        with gzip.open(path, 'rt') as file:
+            header = loads(file.readline())
+            if 'ref' in header:
+                return self.read(directory, header['ref'], 'out')
+            if header['list']:
+                return [loads(line) for line in file]
+            return loads(file.readline())
+
+
+class StepData:
+    # Read-only view of one step checkpoint, every part is read from disk on
+    # first access: context[3]['out'] does not load "in" of step 3.
+    def __init__(self, backend, directory, name):
+        self.backend = backend
+        self.directory = directory
+        self.name = name
+        self.parts = {}
+
+    def __getitem__(self, key):
+        if key not in self.parts:
+            self.parts[key] = self.backend.read(self.directory, self.name, key)
+        return self.parts[key]
+
+    def get(self, key, default=None):
+        value = self[key]
+        return default if value is None else value
+
+    def iter(self, key):
+        # items of a list part one by one, without loading all of them
+        if key in self.parts:
+            return iter(self.parts[key] or [])
+        return self.backend.iter(self.directory, self.name, key)
+
+
+BACKENDS = [JsonlCheckpoint(), JsonCheckpoint()]
+
+
+def load(directory, name):
+    for backend in BACKENDS:
+        if backend.exists(directory, name):
+            return StepData(backend, directory, name)
+
+
+class Journal:
+    # <step>.journal.jsonl - one line {"key": ..., "out": ...} per item of a
+    # loop step that finished without an error, flushed right away so it
+    # survives a crash. With `resume` (the folder of an earlier execution)
+    # items finished there are answered from its journal.
+    def __init__(self, directory, name, resume=None):
+        self.path = directory / f'{name}.journal.jsonl'
+        self.done = {}
+        if resume is not None:
+            path = resume / f'{name}.journal.jsonl'
+            if path.is_file():
+                with open(path) as file:
+                    for line in file:
+                        try:
+                            item = loads(line)
+                        except ValueError:
+                            # last line of a killed run may be cut
+                            continue
+                        self.done[item['key']] = item['out']
+        self.file = None
+        self.skipped = 0
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def get(self, key):
+        self.skipped += 1
+        return self.done[key]
+
+    def record(self, key, out):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(dumps({'key': key, 'out': out}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def project(value, fields):
+    # keep only `fields` of a dict or of every dict in a list
+    if isinstance(value, dict):
+        return {field: value[field] for field in fields if field in value}
+    if isinstance(value, (list, tuple)):
+        return [project(item, fields) for item in value]
+    return value
+
+
+if __name__ == '__main__':
+    # Size/time of one step checkpoint in both formats on Rapid-like
+    # payloads. Run from app/: python -m libs.checkpoint
+    import random
+    import shutil
+    import tempfile
+    import time
+    from pathlib import Path
+
+    def post(i):
+        return {
+            'id': str(random.randrange(10 ** 18)), 'code': f'C{i:010d}',
+            'taken_at': 1700000000 + i, 'like_count': random.randrange(10 ** 6),
+            'caption': {'text': ' '.join(random.choice(['#reel', 'love', 'summer', 'vibes', 'fyp']) for _ in range(30))},
+            'video_versions': [{'url': f'https://cdn.example.com/v/{i}_{j}.mp4?efg={random.randrange(10 ** 12)}', 'width': 720, 'height': 1280} for j in range(3)],
+            'image_versions': {'items': [{'url': f'https://cdn.example.com/i/{i}_{j}.jpg', 'width': 1080} for j in range(4)]},
+            'user': {'pk': str(random.randrange(10 ** 10)), 'username': f'user{i % 500}', 'is_verified': False},
+        }
+
+    data = [post(i) for i in range(50000)]
+    directory = Path(tempfile.mkdtemp())
+    try:
+        for backend, parts, refs in [
+            (JsonCheckpoint(), {'in': data, 'out': data}, None),
+            (JsonlCheckpoint(), {'in': data, 'out': data}, {'in': 'step_0'}),
+        ]:
+            name = f'step_{type(backend).__name__}'
+            start = time.perf_counter()
+            backend.write(directory, name, parts, refs)
+            written = time.perf_counter() - start
+            size = sum(path.stat().st_size for path in directory.glob(f'{name}.*'))
+            start = time.perf_counter()
+            assert len(StepData(backend, directory, name)['out']) == len(data)
+            read = time.perf_counter() - start
+            print(f'{type(backend).__name__}: write {written:.2f}s, read out {read:.2f}s, {size / 1024 ** 2:.1f} MB')
+    finally:
+        shutil.rmtree(directory)
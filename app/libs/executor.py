@@ -0,0 +1,59 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+
+class Executors:
+    # Worker pools for CPU-bound work, created on first use and shut down by
+    # Pipeline at the end of the run.
+    # 'process' - separate interpreters, arguments and results are pickled,
+    #   functions must be importable (module level). Started by forkserver:
+    #   a fork of this process (threads, event loop, open sockets) can
+    #   deadlock in the child. The server preloads the project modules
+    #   imported so far (libs, cache - django is set up once) but not the
+    #   script itself, workers run only its top level outside the
+    #   `if __name__ == '__main__'` guard.
+    # 'thread' - for work that releases the GIL (hashlib on big buffers,
+    #   file io), nothing is copied
+    def __init__(self, processes=None, threads=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.threads = threads or min(32, (os.cpu_count() or 1) + 4)
+        self.pools = {}
+
+    def get(self, kind):
+        if kind not in self.pools:
+            if kind == 'process':
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(preload_modules())
+                self.pools[kind] = ProcessPoolExecutor(self.processes, mp_context=context)
+            elif kind == 'thread':
+                self.pools[kind] = ThreadPoolExecutor(self.threads, thread_name_prefix='offload')
+            else:
+                raise Exception(f'Bad executor: {kind} ["process", "thread"]')
+        return self.pools[kind]
+
+    async def run(self, kind, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get(kind), partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+        self.pools = {}
+
+
+def preload_modules():
+    # sys.modules is in the order imports finished: cache.models finishes
+    # inside django.setup(), before libs.init does, so libs.init goes first
+    names = [name for name in list(sys.modules) if name.split('.')[0] in ['libs', 'cache']]
+    return sorted(names, key=lambda name: name != 'libs.init')
+
+
+executors = Executors()
+
+
+async def offload(kind, func, *args, **kwargs):
+    return await executors.run(kind, func, *args, **kwargs)
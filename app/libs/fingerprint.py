@@ -0,0 +1,91 @@
+import cv2
+import numpy as np
+from libs.hamming import HammingIndex
+
+# Perceptual signature of a video: pHash and dHash of a few keyframes, each
+# bit set by the majority of the frames, stored as 32 hex chars
+# ("<phash:016x><dhash:016x>", fits Reel.video_hash). Re-encoded, resized or
+# re-muxed copies of one video stay within a few bits of each other, unlike
+# the sha256 of the file.
+FRAMES = 8
+PHASH_DISTANCE = 10
+DHASH_DISTANCE = 14
+
+
+def pack(bits):
+    return int(np.packbits(bits.astype(np.uint8)).view('>u8')[0])
+
+
+def phash_bits(gray):
+    # low 8x8 frequencies of the 32x32 DCT against their median, the DC
+    # component (overall brightness) does not vote
+    dct = cv2.dct(np.float32(cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)))
+    low = dct[:8, :8].flatten()
+    return low > np.median(low[1:])
+
+
+def dhash_bits(gray):
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return (small[:, 1:] > small[:, :-1]).flatten()
+
+
+def keyframes(source, frames=FRAMES):
+    # `source` - a file path or an url ffmpeg can read. Frames are taken at
+    # even steps, skipping the very first and last one (fades, black).
+    capture = cv2.VideoCapture(source)
+    try:
+        count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if count <= 0:
+            return
+        for index in np.linspace(0, count - 1, frames + 2)[1:-1].astype(int):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+            ok, frame = capture.read()
+            if ok:
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    finally:
+        capture.release()
+
+
+def video_signature(source, frames=FRAMES):
+    # module level, runs in the process pool: offload('process', video_signature, url)
+    phashes = []
+    dhashes = []
+    for gray in keyframes(source, frames):
+        phashes.append(phash_bits(gray))
+        dhashes.append(dhash_bits(gray))
+    if not phashes:
+        return None
+    phash = pack(np.mean(phashes, axis=0) >= 0.5)
+    dhash = pack(np.mean(dhashes, axis=0) >= 0.5)
+    return f'{phash:016x}{dhash:016x}'
+
+
+def split(signature):
+    return int(signature[:16], 16), int(signature[16:32], 16)
+
+
+def distance(a, b):
+    return tuple((x ^ y).bit_count() for x, y in zip(split(a), split(b)))
+
+
+def find_sources(signatures, max_phash=PHASH_DISTANCE, max_dhash=DHASH_DISTANCE):
+    # `signatures` in posting order (None - no signature). For every item
+    # the index of the original it duplicates or -1: the first earlier item
+    # within both distances, followed to its own original.
+    sources = [-1] * len(signatures)
+    index = HammingIndex()
+    for n, signature in enumerate(signatures):
+        if not signature:
+            continue
+        phash, dhash = split(signature)
+        close = [
+            i for i, _ in index.query(phash, max_phash)
+            if (split(signatures[i])[1] ^ dhash).bit_count() <= max_dhash
+        ]
+        if close:
+            source = min(close)
+            if sources[source] != -1:
+                source = sources[source]
+            sources[n] = source
+        index.add(phash, n)
+    return sources
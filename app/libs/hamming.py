@@ -0,0 +1,158 @@
+import numpy as np
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(2 ** 16)], dtype=np.uint8)
+PENDING = 4096
+
+
+def popcount(values):
+    # set bits of every uint64 in `values`, four 16-bit table lookups each
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return POPCOUNT[values.view(np.uint16)].reshape(-1, 4).sum(axis=1, dtype=np.int32)
+
+
+def to_int(value):
+    # 64-bit hash from an int or hex; a 32 char fingerprint signature
+    # (libs.fingerprint) gives its pHash half
+    if isinstance(value, str):
+        return int(value[:16], 16)
+    return int(value)
+
+
+class HammingIndex:
+    # "All hashes within distance d" over 64-bit hashes, multi-index hashing:
+    # the hash is cut into 4 chunks of 16 bits, if two hashes differ in at
+    # most d bits one of the chunks differs in at most d // 4 of them. Every
+    # chunk has a bucket table (65536 + 1 offsets into an order array), a
+    # query reads the buckets of all chunk values within d // 4 bits and
+    # checks only those candidates with a vectorised popcount.
+    #
+    # build() is the bulk load, add() puts a hash into a small pending list
+    # that is scanned linearly and merged into the tables when it is full.
+    #
+    #   index = HammingIndex.build(
+    #       Reel.objects.exclude(video_hash='').values_list('video_hash', flat=True),
+    #       Reel.objects.exclude(video_hash='').values_list('rapid_id', flat=True),
+    #   )
+    #   index.query(reel.video_hash, 10) -> [(rapid_id, distance), ...]
+    CHUNKS = 4
+    BITS = 16
+
+    def __init__(self):
+        self.values = np.zeros(0, dtype=np.uint64)
+        self.ids = []
+        self.tables = []
+        self.pending = []
+        self.pending_ids = []
+        self.masks = {}
+
+    @classmethod
+    def build(cls, values, ids=None):
+        index = cls()
+        values = [to_int(value) for value in values]
+        index.merge(values, list(ids) if ids is not None else list(range(len(values))))
+        return index
+
+    def __len__(self):
+        return len(self.ids) + len(self.pending_ids)
+
+    def chunks(self, values):
+        shift = np.arange(self.CHUNKS, dtype=np.uint64) * np.uint64(self.BITS)
+        return ((values[:, None] >> shift) & np.uint64(2 ** self.BITS - 1)).astype(np.int64)
+
+    def merge(self, values, ids):
+        self.values = np.concatenate([self.values, np.array(values, dtype=np.uint64)])
+        self.ids.extend(ids)
+        self.tables = []
+        for chunk in self.chunks(self.values).T:
+            order = np.argsort(chunk, kind='stable')
+            starts = np.zeros(2 ** self.BITS + 1, dtype=np.int64)
+            np.cumsum(np.bincount(chunk, minlength=2 ** self.BITS), out=starts[1:])
+            self.tables.append((starts, order))
+
+    def add(self, value, id_=None):
+        self.pending.append(to_int(value))
+        self.pending_ids.append(len(self) if id_ is None else id_)
+        if len(self.pending) >= PENDING:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.merge(self.pending, self.pending_ids)
+            self.pending = []
+            self.pending_ids = []
+
+    def get_masks(self, radius):
+        # every 16-bit xor mask with at most `radius` bits set
+        if radius not in self.masks:
+            every = np.arange(2 ** self.BITS, dtype=np.uint64)
+            self.masks[radius] = every[popcount(every) <= radius].astype(np.int64)
+        return self.masks[radius]
+
+    def candidates(self, value, distance):
+        masks = self.get_masks(distance // self.CHUNKS)
+        found = []
+        for chunk, (starts, order) in zip(self.chunks(np.array([value], dtype=np.uint64))[0], self.tables):
+            probes = chunk ^ masks
+            low = starts[probes]
+            counts = starts[probes + 1] - low
+            total = counts.sum()
+            if total:
+                # concatenated ranges low[i]:low[i] + counts[i]
+                offsets = np.repeat(low - np.cumsum(counts) + counts, counts)
+                found.append(order[offsets + np.arange(total)])
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        # a hash close in several chunks comes more than once, query()
+        # removes the repeats after the distance check (far cheaper)
+        return np.concatenate(found)
+
+    def query(self, value, distance):
+        # [(id, distance), ...] nearest first, ids in insertion order on ties
+        value = to_int(value)
+        result = []
+        if len(self.values):
+            found = self.candidates(value, distance)
+            distances = popcount(self.values[found] ^ np.uint64(value))
+            close = distances <= distance
+            close = dict(zip(found[close].tolist(), distances[close].tolist()))
+            result = [(self.ids[i], d, i) for i, d in close.items()]
+        if self.pending:
+            distances = popcount(np.array(self.pending, dtype=np.uint64) ^ np.uint64(value))
+            for i in np.flatnonzero(distances <= distance).tolist():
+                result.append((self.pending_ids[i], int(distances[i]), len(self.ids) + i))
+        result.sort(key=lambda item: (item[1], item[2]))
+        return [(id_, d) for id_, d, _ in result]
+
+
+if __name__ == '__main__':
+    # 1M random 64-bit hashes, the queries are 1000 of them with 8 bits
+    # flipped, against a linear numpy scan. Run from app/: python -m libs.hamming
+    import time
+
+    rng = np.random.default_rng(1)
+    values = rng.integers(0, 2 ** 63, 1000000, dtype=np.int64).astype(np.uint64) * np.uint64(2) + rng.integers(0, 2, 1000000).astype(np.uint64)
+
+    start = time.perf_counter()
+    index = HammingIndex.build(values.tolist())
+    print(f'build: {len(index)} hashes, {time.perf_counter() - start:.2f}s')
+
+    queries = []
+    for value in values[:1000].tolist():
+        for bit in rng.choice(64, 8, replace=False).tolist():
+            value ^= 1 << bit
+        queries.append(value)
+    for distance in [3, 6, 10]:
+        start = time.perf_counter()
+        hits = sum(len(index.query(value, distance)) > 0 for value in queries)
+        elapsed = (time.perf_counter() - start) / len(queries) * 1000
+        print(f'query d={distance}: {elapsed:.3f} ms, {hits}/{len(queries)} found (8 bits changed)')
+
+    start = time.perf_counter()
+    for value in rng.integers(0, 2 ** 62, 10000).tolist():
+        index.add(value)
+    print(f'add: 10000 hashes, {time.perf_counter() - start:.2f}s')
+
+    start = time.perf_counter()
+    for value in queries[:100]:
+        popcount(values ^ np.uint64(value)) <= 10
+    print(f'linear scan: {(time.perf_counter() - start) / 100 * 1000:.3f} ms per query')
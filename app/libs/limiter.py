@@ -0,0 +1,173 @@
+import asyncio
+import time
+from contextlib import nullcontext
+from functools import wraps
+from libs.logs import logger
+
+
+class TokenBucket:
+    # rate - tokens per second, capacity - how many calls may burst at once.
+    # Waiters are served strictly in arrival order: only the head of the queue
+    # sleeps for the next token, everybody else waits on the FIFO lock.
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=asyncio.sleep):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = asyncio.Lock()
+
+        self.queued = 0
+        self.acquired = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        start = self.clock()
+        self.queued += 1
+        try:
+            async with self.lock:
+                self.refill()
+                while self.tokens < 1 - 1e-9:
+                    await self.sleep((1 - self.tokens) / self.rate)
+                    self.refill()
+                self.tokens -= 1
+        finally:
+            self.queued -= 1
+        wait = self.clock() - start
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        self.refill()
+        return {
+            'rate': self.rate,
+            'capacity': self.capacity,
+            'tokens': round(self.tokens, 3),
+            'queued': self.queued,
+            'acquired': self.acquired,
+            'avg_wait': round(self.total_wait / self.acquired, 3) if self.acquired else 0,
+            'max_wait': round(self.max_wait, 3)
+        }
+
+
+class Limiter:
+    # Registry of token buckets per tag (and per key inside a tag, e.g. one
+    # bucket for every Airtable base) plus semaphores that cap the number of
+    # requests in flight instead of polling the request counter.
+    def __init__(self, _request_counter=None, max_active=None, clock=time.monotonic, sleep=asyncio.sleep):
+        self._request_counter = _request_counter
+        if max_active is None and _request_counter:
+            max_active = _request_counter["max_active_requests"]
+        self.clock = clock
+        self.sleep = sleep
+        self.configs = {}
+        self.buckets = {}
+        self.semaphores = {}
+        self.active = asyncio.Semaphore(max_active) if max_active else nullcontext()
+
+    def configure(self, tag, rate, capacity=None, concurrency=None):
+        self.configs[tag] = {
+            'rate': rate,
+            'capacity': capacity,
+        }
+        if concurrency is not None:
+            self.semaphores[tag] = asyncio.Semaphore(concurrency)
+        return self
+
+    def bucket(self, name):
+        if name not in self.buckets:
+            tag = name.split(':')[0]
+            if tag not in self.configs:
+                error = f'Limiter tag is not configured: {tag}'
+                logger.error(error)
+                raise Exception(error)
+            config = self.configs[tag]
+            self.buckets[name] = TokenBucket(
+                config['rate'], config['capacity'], self.clock, self.sleep
+            )
+        return self.buckets[name]
+
+    async def acquire(self, name):
+        await self.bucket(name).acquire()
+
+    def limit(self, tag, key=None):
+        # key(*args, **kwargs) -> str splits one tag into independent buckets
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                name = tag
+                if key is not None:
+                    name = f'{tag}:{key(*args, **kwargs)}'
+                # a slot first: a token taken while queued for a slot is
+                # spent long before the request is sent
+                async with self.semaphores.get(tag, self.active):
+                    await self.acquire(name)
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return {name: bucket.stats() for name, bucket in self.buckets.items()}
+
+    def summary(self):
+        parts = []
+        for name, stats in self.stats().items():
+            parts.append(f"{name}: {stats['tokens']}/{stats['capacity']} q={stats['queued']} w={stats['avg_wait']}s")
+        return '; '.join(parts)
+
+
+if __name__ == '__main__':
+    # Simulated clock check: 1000 concurrent callers against a 10 rps bucket
+    # with burst 10 must take exactly (1000 - 10) / 10 seconds of virtual
+    # time and be served in arrival order.
+    # Run from app/: python -m libs.limiter
+    class FakeClock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+        async def sleep(self, seconds):
+            self.now += seconds
+            await asyncio.sleep(0)
+
+    async def simulate(callers, rate, capacity):
+        clock = FakeClock()
+        limiter = Limiter(max_active=callers, clock=clock, sleep=clock.sleep)
+        limiter.configure('sim', rate, capacity)
+        order = []
+        grants = []
+
+        @limiter.limit('sim')
+        async def call(i):
+            order.append(i)
+            grants.append(clock())
+
+        await asyncio.gather(*[call(i) for i in range(callers)])
+        expected = (callers - capacity) / rate
+        elapsed = grants[-1] - grants[0]
+        achieved = (callers - capacity) / elapsed
+        assert order == list(range(callers)), 'waiters were not served FIFO'
+        assert abs(elapsed - expected) < 1e-6, f'{elapsed} != {expected}'
+        assert abs(achieved - rate) < 1e-6, f'{achieved} != {rate}'
+        # no one-second window may see more than burst + rate grants
+        start = 0
+        for end in range(callers):
+            while grants[end] - grants[start] > 1 + 1e-9:
+                start += 1
+            assert end - start + 1 <= capacity + rate, 'rate exceeded'
+        print(f'rate={rate} burst={capacity} callers={callers}: {elapsed:.3f}s virtual, {achieved:.3f} rps')
+        print(limiter.summary())
+
+    asyncio.run(simulate(1000, 10, 10))
+    asyncio.run(simulate(1000, 9, 1))
+    asyncio.run(simulate(1000, 4, 1))
@@ -1,25 +1,85 @@
 import asyncio
-from json import dumps, loads
+from json import dumps
 from datetime import datetime
 from libs.logs import logger, execution_logger, error_logger, EXEC_ID
 from traceback import format_exc
 from libs.stack import PrintedStack
 from libs.dirs import PIPE_DIR
+from libs.session import session_pool
+from libs.archive import request_archive
+from libs.writequeue import close_write_queues
+from libs.executor import executors
+from libs.utils import chunks
+from libs.checkpoint import JsonlCheckpoint, Journal, load, project
+from itertools import count
 import atexit
 import signal
 
-INDENT = 4
 OUT = PrintedStack(15, True)
+LOOPS = [False, 'loop', 'aloop', 'flatten', 'batch']
+STREAM_END = object()
+# run_step source of a step whose input is not the output of one step
+NO_SOURCE = object()
 
 
 class Step:
-    def __init__(self, handler: 'coro', const: 'Const|None' = None, name: 'str' = '', isloop: 'bool|str' = False, mapper: "str|None" = None):
+    def __init__(self, handler: 'coro', const: 'Const|None' = None, name: 'str' = '', isloop: 'bool|str' = False, mapper: "str|None" = None, concurrency: 'int|None' = None, ordered: 'bool' = True, size: 'int|None' = None, checkpoint: 'str|list' = 'both', key: 'callable|None' = None, after: 'list|None' = None, executor: 'str|None' = None):
         self.handler = handler
         self.const = const
         self.name = name
         self.isloop = isloop
-        if self.isloop not in [False, 'loop', 'aloop']:
-            error = f'Bad Loop Flag: {self.isloop} [False, "loop", "aloop"]'
+        if self.isloop not in LOOPS:
+            error = f'Bad Loop Flag: {self.isloop} {LOOPS}'
+            error_logger.error(error)
+            raise Exception(error)
+
+        # flatten - list of lists -> list, batch - list -> lists of `size`,
+        # both are done by the pipeline and take no handler
+        self.size = size
+        if self.isloop in ['flatten', 'batch'] and self.handler is not None:
+            error = f'{self.isloop} step takes no handler: {self.name}'
+            error_logger.error(error)
+            raise Exception(error)
+        if self.isloop == 'batch' and (not isinstance(self.size, int) or self.size < 1):
+            error = f'Bad Batch Size: {self.size}'
+            error_logger.error(error)
+            raise Exception(error)
+
+        # what is saved after the step: 'both' - in and out, 'out', 'none'
+        # or a list of fields kept from out (set_exec replays what is saved)
+        self.checkpoint = checkpoint
+        if self.checkpoint not in ['both', 'out', 'none'] and not isinstance(self.checkpoint, list):
+            error = f'Bad Checkpoint: {self.checkpoint} ["both", "out", "none", [fields]]'
+            error_logger.error(error)
+            raise Exception(error)
+
+        # loop/aloop: key(item) -> str, every finished item is journaled under
+        # it and skipped when the pipeline resumes an execution. None - the
+        # item is not journaled. For a batch (list) item key may give a list,
+        # one key per element: elements are journaled one by one, the ones
+        # done are dropped from the batch, an empty batch is skipped.
+        self.key = key
+        if self.key is not None and self.isloop not in ['loop', 'aloop']:
+            error = f'Key needs a loop step: {self.name}'
+            error_logger.error(error)
+            raise Exception(error)
+
+        # names of the steps this one depends on, None - the previous step
+        self.after = after
+        if self.after is not None and not isinstance(self.after, list):
+            error = 'After must be list of step names!'
+            error_logger.error(error)
+            raise Exception(error)
+
+        # sync handler run in a worker pool: 'process' (CPU-bound, gets
+        # pipe=None - the state stays in this process) or 'thread'
+        self.executor = executor
+        if self.executor not in [None, 'process', 'thread']:
+            error = f'Bad Executor: {self.executor} [None, "process", "thread"]'
+            error_logger.error(error)
+            raise Exception(error)
+        if self.executor is not None and asyncio.iscoroutinefunction(self.handler):
+            error = f'Executor needs a sync handler: {self.name}'
             error_logger.error(error)
             raise Exception(error)
 
@@ -29,6 +89,24 @@ class Step:
             error_logger.error(error)
             raise Exception(error)
 
+        # aloop only: at most `concurrency` iterations in flight,
+        # ordered=False returns results in completion order
+        self.concurrency = concurrency
+        self.ordered = ordered
+        if self.concurrency is not None and (not isinstance(self.concurrency, int) or self.concurrency < 1):
+            error = f'Bad Concurrency: {self.concurrency}'
+            error_logger.error(error)
+            raise Exception(error)
+
+    def get_checkpoint(self, data_in, data_out):
+        if self.checkpoint == 'both':
+            return {'in': data_in, 'out': data_out}
+        if self.checkpoint == 'out':
+            return {'out': data_out}
+        if self.checkpoint == 'none':
+            return {}
+        return {'out': project(data_out, self.checkpoint)}
+
     def get_map(self, out):
         if self.mapper is None:
             return out
@@ -44,7 +122,12 @@ class Step:
             return out
 
     async def _run(self, pipe: 'Pipeline', data: 'dict|list|None' = None, context: 'Const|None' = None, iteration=None, step_number=None) -> 'dict|list|None':
-        out = await self.handler(data=data, context=context, const=self.const, pipe=pipe, iteration=iteration, step_number=step_number)
+        if self.executor is not None:
+            if self.executor == 'process':
+                pipe = None
+            out = await executors.run(self.executor, self.handler, data=data, context=context, const=self.const, pipe=pipe, iteration=iteration, step_number=step_number)
+        else:
+            out = await self.handler(data=data, context=context, const=self.const, pipe=pipe, iteration=iteration, step_number=step_number)
         if isinstance(out, (dict, list, tuple)) or out is None:
             return out
         else:
@@ -54,18 +137,32 @@ class Step:
 
     async def run(self, pipe: 'Pipeline', data: 'dict|list|None' = None, context: 'Const|None' = None, iteration=None, step_number=None, root_pipe: 'Pipeline' = None) -> 'dict|list|None':
         if iteration is not None:
-            root_pipe.current_loop['active'] += 1
+            loop = root_pipe.loops[self.name]
+            loop['active'] += 1
             try:
-                OUT.print(f'Start A Iteration {iteration}')
-                answer = await self._run(pipe, data, context, iteration=iteration, step_number=step_number)
-                OUT.print(f'End A Iteration {iteration}')
+                key = None
+                if self.key is not None:
+                    journal = root_pipe.get_journal(self)
+                    key = self.key(data)
+                if isinstance(key, list):
+                    answer = await self.run_batch(pipe, data, context, iteration, step_number, journal, [str(item) for item in key], root_pipe)
+                elif key is not None and str(key) in journal:
+                    OUT.print(f'Skip A Iteration {iteration}, done in {root_pipe.resume}')
+                    answer = journal.get(str(key))
+                    journal.record(str(key), answer)
+                else:
+                    OUT.print(f'Start A Iteration {iteration}')
+                    answer = await self._run(pipe, data, context, iteration=iteration, step_number=step_number)
+                    OUT.print(f'End A Iteration {iteration}')
+                    if key is not None:
+                        journal.record(str(key), answer)
             except Exception:
                 error = f'Error in iteration {iteration}'+'\n'+f'{format_exc()}'
                 OUT.print(error)
                 error_logger.error(error)
                 answer = None
-            root_pipe.current_loop['active'] -= 1
-            root_pipe.current_loop['finished'] += 1
+            loop['active'] -= 1
+            loop['finished'] += 1
         else:
             try:
                 answer = await self._run(pipe, data, context)
@@ -76,6 +173,23 @@ class Step:
                 raise e
         return answer
 
+    async def run_batch(self, pipe, data, context, iteration, step_number, journal, keys, root_pipe):
+        todo = []
+        for item, key in zip(data, keys):
+            if key in journal:
+                journal.record(key, journal.get(key))
+            else:
+                todo.append((item, key))
+        if not todo:
+            OUT.print(f'Skip A Iteration {iteration}, done in {root_pipe.resume}')
+            return None
+        OUT.print(f'Start A Iteration {iteration}')
+        answer = await self._run(pipe, [item for item, _ in todo], context, iteration=iteration, step_number=step_number)
+        OUT.print(f'End A Iteration {iteration}')
+        for _, key in todo:
+            journal.record(key, None)
+        return answer
+
     def __gt__(self, other):
         pipe = Pipeline()
         pipe.steps.append(self)
@@ -94,9 +208,11 @@ class Context:
         self.id_ = id_
 
     def __getitem__(self, key):
-        data_src = PIPE_DIR / f'{str(self.id_)}/step_{key}.json'
-        if data_src.is_file():
-            return loads(data_src.read_text())
+        # parts of the step are read when they are used: context[3]['out'],
+        # or by step name: context['step_3']['out']
+        if isinstance(key, int):
+            key = f'step_{key}'
+        return load(PIPE_DIR / str(self.id_), key)
 
 
 class Pipeline:
@@ -112,10 +228,15 @@ class Pipeline:
             self.context = Context(self.id)
         self.exec = None
         self.exec_steps = []
+        self.stream = None
+        self.checkpoint = JsonlCheckpoint()
+        self.resume = None
+        self.journals = {}
+        self.closers = []
 
         self.time_handler = None
         self.time_run = True
-        self.current_loop = None
+        self.loops = {}
 
         self.global_start = datetime.now()
         self.elapsed = None
@@ -123,6 +244,21 @@ class Pipeline:
         signal.signal(signal.SIGINT, self.exit)
         atexit.register(self.atexit)
 
+    @property
+    def current_loop(self):
+        # running loops (several with streaming or parallel branches) summed up
+        loops = list({id(loop): loop for loop in self.loops.values()}.values())
+        if not loops:
+            return None
+        if len(loops) == 1:
+            return loops[0]
+        return {
+            'name': ' | '.join(loop['name'] for loop in loops),
+            'max': sum(loop['max'] for loop in loops),
+            'active': sum(loop['active'] for loop in loops),
+            'finished': sum(loop['finished'] for loop in loops)
+        }
+
     def exit(self, signum, frame):
         self.last_status = 'killed'
         exit(1)
@@ -154,6 +290,29 @@ class Pipeline:
         self.exec = exec_
         self.exec_steps = steps
 
+    def on_shutdown(self, close):
+        # coroutine function awaited at the end of the run (db pools etc.)
+        self.closers.append(close)
+
+    def set_resume(self, exec_):
+        # loop steps with a key skip the items finished in execution exec_
+        self.resume = exec_
+
+    def get_journal(self, step):
+        if step.name not in self.journals:
+            resume = None
+            if self.resume is not None:
+                resume = PIPE_DIR / str(self.resume)
+            self.journals[step.name] = Journal(self._dir, step.name, resume)
+        return self.journals[step.name]
+
+    def close_journals(self):
+        for name, journal in self.journals.items():
+            journal.close()
+            if journal.skipped:
+                logger.info(f'{name}: {journal.skipped} items taken from {self.resume}')
+        self.journals = {}
+
     async def timer(self):
         start = datetime.now()
         while self.time_run:
@@ -173,58 +332,18 @@ class Pipeline:
             OUT.print(f'Start Execution: {name} with id: {self.id}')
             logger.info(f'Start Execution: {name} with id: {self.id}')
             self.write_status(self.get_status())
-            for i, step in enumerate(self.steps):
-                self.write_status(self.get_status(f'{step.name} [{i+1}]'))
-                OUT.print(f'Start Step {i} {step.name}')
-                logger.info(f'Start Step {i} {step.name}')
-                local_start = datetime.now()
-                context = {'in': step_out, 'out': None}
-                if self.exec is None or step.name not in self.exec_steps:
-                    if step.isloop is False:
-                        step_out = await step.run(data=step_out, context=self.context, pipe=self.state, step_number=i)
-                    elif step.isloop == 'loop' and isinstance(step.get_map(step_out), (list, tuple)):
-                        _step_out = []
-                        self.current_loop = {
-                            'name': step.name,
-                            'max': len(step.get_map(step_out)),
-                            'active': 0,
-                            'finished': 0
-                        }
-                        for j, item in enumerate(step.get_map(step_out)):
-                            data = await step.run(data=item, context=self.context, pipe=self.state, iteration=j, step_number=i, root_pipe=self)
-                            if data is not None:
-                                _step_out.append(data)
-                            execution_logger.info(f'End {j} iteration')
-                        step_out = _step_out
-                        self.current_loop = None
-                    elif step.isloop == 'aloop' and isinstance(step.get_map(step_out), (list, tuple)):
-                        tasks = []
-                        self.current_loop = {
-                            'name': step.name,
-                            'max': len(step.get_map(step_out)),
-                            'active': 0,
-                            'finished': 0
-                        }
-                        for j, item in enumerate(step.get_map(step_out)):
-                            tasks.append(step.run(data=item, context=self.context, pipe=self.state, iteration=j, step_number=i, root_pipe=self))
-                        step_out = await asyncio.gather(*tasks)
-                        step_out = [item for item in step_out if item is not None]
-                        self.current_loop = None
-                    elif step.isloop in ['loop', 'aloop'] and not isinstance(step.get_map(step_out), (list, tuple)):
-                        error = f'Bad input data: {step_out}'
-                        error_logger.error(error)
-                        raise Exception(error)
-                else:
-                    OUT.print(f"Load out from exec {self.exec}")
-                    step_out = loads((PIPE_DIR / str(self.exec) / f'{step.name}.json').read_text())["out"]
-
-                context['out'] = step_out
-                (self._dir / f'{step.name}.json').write_text(
-                    dumps(context, indent=INDENT)
-                )
-                OUT.print(f'Step {i} {step.name} Duration: {datetime.now() - local_start}')
-                logger.info(f'Step {i} {step.name} Duration: {datetime.now() - local_start}')
-                self.write_status(self.get_status(f'{step.name}[{i}]'))
+            if self.is_graph():
+                step_out = await self.run_graph()
+            else:
+                i = 0
+                while i < len(self.steps):
+                    segment = self.get_segment(i)
+                    if len(segment) > 1:
+                        step_out = await self.run_segment(segment, i, step_out)
+                        i += len(segment)
+                    else:
+                        step_out = await self.run_step(i, self.steps[i], step_out)
+                        i += 1
 
             OUT.print(f'Duration: {datetime.now() - self.global_start}')
             OUT.print(f'End Execution {self.id}')
@@ -236,6 +355,295 @@ class Pipeline:
             error_logger.error(f'{format_exc()}')
             self.last_status = 'fatal error'
             exit(1)
+        finally:
+            await self.shutdown()
+
+    async def run_step(self, i, step, step_out, source=None):
+        # source - the step `step_out` came from, default is the previous one,
+        # NO_SOURCE - none (the input is saved as it is)
+        if source is None and i > 0:
+            source = self.steps[i - 1]
+        if source is NO_SOURCE:
+            source = None
+        self.write_status(self.get_status(f'{step.name} [{i+1}]'))
+        OUT.print(f'Start Step {i} {step.name}')
+        logger.info(f'Start Step {i} {step.name}')
+        local_start = datetime.now()
+        data_in = step_out
+        if self.exec is None or step.name not in self.exec_steps:
+            if step.isloop is False:
+                step_out = await step.run(data=step_out, context=self.context, pipe=self.state, step_number=i)
+            elif step.isloop == 'loop' and isinstance(step.get_map(step_out), (list, tuple)):
+                _step_out = []
+                self.loops[step.name] = {
+                    'name': step.name,
+                    'max': len(step.get_map(step_out)),
+                    'active': 0,
+                    'finished': 0
+                }
+                for j, item in enumerate(step.get_map(step_out)):
+                    data = await step.run(data=item, context=self.context, pipe=self.state, iteration=j, step_number=i, root_pipe=self)
+                    if data is not None:
+                        _step_out.append(data)
+                    execution_logger.info(f'End {j} iteration')
+                step_out = _step_out
+                self.loops.pop(step.name)
+            elif step.isloop == 'aloop' and isinstance(step.get_map(step_out), (list, tuple)):
+                tasks = []
+                self.loops[step.name] = {
+                    'name': step.name,
+                    'max': len(step.get_map(step_out)),
+                    'active': 0,
+                    'finished': 0
+                }
+                if step.concurrency is not None:
+                    step_out = await self.run_pool(step, step.get_map(step_out), i)
+                else:
+                    for j, item in enumerate(step.get_map(step_out)):
+                        tasks.append(step.run(data=item, context=self.context, pipe=self.state, iteration=j, step_number=i, root_pipe=self))
+                    step_out = await asyncio.gather(*tasks)
+                step_out = [item for item in step_out if item is not None]
+                self.loops.pop(step.name)
+            elif step.isloop == 'flatten' and isinstance(step.get_map(step_out), (list, tuple)):
+                step_out = [item for items in step.get_map(step_out) for item in items]
+            elif step.isloop == 'batch' and isinstance(step.get_map(step_out), (list, tuple)):
+                step_out = list(chunks(step.get_map(step_out), step.size))
+            elif not isinstance(step.get_map(step_out), (list, tuple)):
+                error = f'Bad input data: {step_out}'
+                error_logger.error(error)
+                raise Exception(error)
+        else:
+            OUT.print(f"Load out from exec {self.exec}")
+            step_out = load(PIPE_DIR / str(self.exec), step.name)['out']
+
+        await self.save(step, data_in, step_out, source)
+        OUT.print(f'Step {i} {step.name} Duration: {datetime.now() - local_start}')
+        logger.info(f'Step {i} {step.name} Duration: {datetime.now() - local_start}')
+        self.write_status(self.get_status(f'{step.name}[{i}]'))
+        return step_out
+
+    def get_after(self, i):
+        # names of the steps `self.steps[i]` waits for
+        step = self.steps[i]
+        if step.after is not None:
+            return step.after
+        if i == 0:
+            return []
+        return [self.steps[i - 1].name]
+
+    def is_graph(self):
+        return any(step.after is not None for step in self.steps)
+
+    async def run_graph(self):
+        # Every step starts as soon as the steps in its `after` are done, so
+        # independent branches run at the same time. A step gets the output
+        # of its only dependency, or {name: output} when it has several.
+        # Outputs are dropped once every step that needs them has started.
+        steps = {step.name: step for step in self.steps}
+        for i, step in enumerate(self.steps):
+            for name in self.get_after(i):
+                if name not in steps or name == step.name:
+                    error = f'Bad dependency of {step.name}: {name}'
+                    error_logger.error(error)
+                    raise Exception(error)
+        done = {name: asyncio.Event() for name in steps}
+        users = {name: 0 for name in steps}
+        for i in range(len(self.steps)):
+            for name in self.get_after(i):
+                users[name] += 1
+        outputs = {}
+
+        async def node(i, step):
+            after = self.get_after(i)
+            for name in after:
+                await done[name].wait()
+            source = NO_SOURCE
+            if len(after) == 1:
+                data = outputs[after[0]]
+                source = steps[after[0]]
+            elif after:
+                data = {name: outputs[name] for name in after}
+            else:
+                data = None
+            for name in after:
+                users[name] -= 1
+                if users[name] == 0:
+                    outputs.pop(name)
+            outputs[step.name] = await self.run_step(i, step, data, source)
+            done[step.name].set()
+
+        tasks = [asyncio.create_task(node(i, step)) for i, step in enumerate(self.steps)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return outputs.get(self.steps[-1].name)
+
+    async def run_pool(self, step, items, step_number):
+        # `concurrency` workers share one iterator over the items, so only
+        # that many iterations (and their coroutines) exist at any moment
+        source = iter(enumerate(items))
+        if step.ordered:
+            results = [None] * len(items)
+        else:
+            results = []
+
+        async def worker():
+            for j, item in source:
+                answer = await step.run(data=item, context=self.context, pipe=self.state, iteration=j, step_number=step_number, root_pipe=self)
+                if step.ordered:
+                    results[j] = answer
+                else:
+                    results.append(answer)
+
+        await asyncio.gather(*[worker() for _ in range(min(step.concurrency, len(items)))])
+        return results
+
+    def set_checkpoint(self, checkpoint):
+        self.checkpoint = checkpoint
+
+    async def save(self, step, data_in, data_out, source=None):
+        # Written in a thread so the timer keeps running, but awaited: the
+        # next step may change the same objects. `source` is the step that
+        # produced data_in, its saved "out" is referenced instead of a copy.
+        parts = step.get_checkpoint(data_in, data_out)
+        refs = {}
+        if 'in' in parts and source is not None and source.checkpoint in ['both', 'out']:
+            refs['in'] = source.name
+        if parts:
+            await asyncio.to_thread(self.checkpoint.write, self._dir, step.name, parts, refs)
+
+    def set_stream(self, size=100):
+        # Consecutive loop steps run at the same time, connected by queues of
+        # at most `size` items: an item goes to the next step as soon as it
+        # is ready instead of waiting for the whole list. Only for linear
+        # pipelines, with `after` every step runs as a whole.
+        self.stream = size
+
+    def get_segment(self, start):
+        # steps from `start` that can be streamed together, a step with a
+        # mapper needs the whole previous output and starts a new segment
+        segment = []
+        if self.stream is None:
+            return segment
+        for step in self.steps[start:]:
+            if step.isloop is False or (segment and step.mapper is not None):
+                break
+            if self.exec is not None and step.name in self.exec_steps:
+                break
+            segment.append(step)
+        return segment
+
+    async def run_segment(self, segment, start, step_out):
+        names = ' > '.join(step.name for step in segment)
+        self.write_status(self.get_status(f'{names} [{start+1}]'))
+        OUT.print(f'Start Stream {start} {names}')
+        logger.info(f'Start Stream {start} {names}')
+        local_start = datetime.now()
+
+        source = segment[0].get_map(step_out)
+        if not isinstance(source, (list, tuple)):
+            error = f'Bad input data: {step_out}'
+            error_logger.error(error)
+            raise Exception(error)
+
+        # one current_loop for the whole segment: max grows as items reach
+        # a step with a handler, active/finished count every iteration
+        loop = {
+            'name': names,
+            'max': 0,
+            'active': 0,
+            'finished': 0
+        }
+        for step in segment:
+            self.loops[step.name] = loop
+        queues = [asyncio.Queue(self.stream) for _ in segment]
+        outs = [[] for _ in segment]
+
+        async def put(k, item):
+            if segment[k].isloop in ['loop', 'aloop']:
+                loop['max'] += 1
+            await queues[k].put(item)
+
+        async def feed():
+            for item in source:
+                await put(0, item)
+            await queues[0].put(STREAM_END)
+
+        async def stage(k, step):
+            inbox = queues[k]
+
+            async def emit(item):
+                outs[k].append(item)
+                if k + 1 < len(segment):
+                    await put(k + 1, item)
+
+            if step.isloop in ['loop', 'aloop']:
+                iterations = count()
+
+                async def worker():
+                    while True:
+                        item = await inbox.get()
+                        if item is STREAM_END:
+                            # let the other workers of this step see it too
+                            inbox.put_nowait(STREAM_END)
+                            return
+                        answer = await step.run(data=item, context=self.context, pipe=self.state, iteration=next(iterations), step_number=start + k, root_pipe=self)
+                        if answer is not None:
+                            await emit(answer)
+
+                workers = 1 if step.isloop == 'loop' else step.concurrency or self.stream
+                await asyncio.gather(*[worker() for _ in range(workers)])
+            elif step.isloop == 'flatten':
+                while (items := await inbox.get()) is not STREAM_END:
+                    for item in items:
+                        await emit(item)
+            elif step.isloop == 'batch':
+                batch = []
+                while (item := await inbox.get()) is not STREAM_END:
+                    batch.append(item)
+                    if len(batch) == step.size:
+                        await emit(batch)
+                        batch = []
+                if batch:
+                    await emit(batch)
+            if k + 1 < len(segment):
+                await queues[k + 1].put(STREAM_END)
+
+        tasks = [asyncio.create_task(feed())]
+        tasks += [asyncio.create_task(stage(k, step)) for k, step in enumerate(segment)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            for step in segment:
+                self.loops.pop(step.name)
+
+        data_in = step_out
+        source = self.steps[start - 1] if start > 0 else None
+        for step, out in zip(segment, outs):
+            await self.save(step, data_in, out, source)
+            data_in = out
+            source = step
+        OUT.print(f'Stream {start} {names} Duration: {datetime.now() - local_start}')
+        logger.info(f'Stream {start} {names} Duration: {datetime.now() - local_start}')
+        self.write_status(self.get_status(f'{names}[{start}]'))
+        return outs[-1]
+
+    async def shutdown(self):
+        self.close_journals()
+        await asyncio.to_thread(executors.shutdown)
+        # pending Airtable writes go first, they still need the sessions
+        for close in [*self.closers, close_write_queues, request_archive.close, session_pool.close]:
+            try:
+                await close()
+            except Exception:
+                error_logger.error(f'{format_exc()}')
 
     async def run_with_timer(self, name="Undefined Process"):
         await asyncio.gather(
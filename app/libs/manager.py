@@ -1,7 +1,8 @@
 from libs.dirs import (
     PIPE_DIR, LOG_DIR, REQUEST_DIR, EXECUTION_LOG_DIR, REQUEST_LOG_DIR
 )
-from json import loads
+from libs.archive import RequestArchive
+from json import loads, dumps
 from datetime import datetime, timedelta
 
 
@@ -71,6 +72,15 @@ class Manager:
         else:
             print("Sorry but we don't have any record with this ID.")
 
+    def get_request(self, id_):
+        for exec_dir in self.REQUEST_DIR.glob("*/"):
+            record = RequestArchive.lookup(exec_dir, id_)
+            if record is not None:
+                print(f"EXEC: {exec_dir.name}")
+                print(dumps(record, indent=4))
+                return record
+        print("Sorry but we don't have any request with this ID.")
+
     def clear_old_record(self, hours):
         execs = self.get_execs()
         now = datetime.now()
@@ -0,0 +1,44 @@
+from json import loads, dumps
+from pathlib import Path
+
+
+class HighWaterMarks:
+    # Newest post we have already seen per account, kept between runs in a
+    # json file, so daily re-scrapes can stop paging once they reach it.
+    # A new mark is staged with the number of posts fetched for it and
+    # applied by save() only when every one of them was done() (sent, or
+    # left out on purpose); otherwise the old mark stays and the posts are
+    # fetched again on the next run.
+    def __init__(self, path):
+        self.path = Path(path)
+        self.marks = self.load()
+        self.pending = {}
+
+    def load(self):
+        try:
+            return loads(self.path.read_text())
+        except Exception:
+            return {}
+
+    def get(self, account):
+        return self.marks.get(str(account), None)
+
+    def update(self, account, post_id, created):
+        mark = self.get(account)
+        if mark is None or created > mark['created']:
+            self.marks[str(account)] = {'id': post_id, 'created': created}
+
+    def stage(self, key, account, post_id, created, posts):
+        # key - what done() is called with (the Airtable account record)
+        self.pending[key] = {'account': account, 'id': post_id, 'created': created, 'left': posts}
+
+    def done(self, key, posts=1):
+        if key in self.pending:
+            self.pending[key]['left'] -= posts
+
+    def save(self):
+        for mark in self.pending.values():
+            if mark['left'] <= 0:
+                self.update(mark['account'], mark['id'], mark['created'])
+        self.pending = {}
+        self.path.write_text(dumps(self.marks, indent=4))
@@ -0,0 +1,100 @@
+class DuplicateMatcher:
+    # Source lookup for the duplicate scripts, one matcher per model. Items
+    # are checked in posting order, an item is a duplicate of the first one
+    # that has (in this priority):
+    #   - the same file hash
+    #   - the same sound and exactly the same duration
+    #   - the same sound and the same duration rounded to 0.1s (potential)
+    #   - a duration within `tolerance_ms` whatever the sound (potential)
+    # Duplicates are indexed under their original, so a chain of reposts
+    # always points to the first post. Every lookup is a few dict gets.
+    def __init__(self, tolerance_ms=2):
+        self.tolerance_ms = tolerance_ms
+        self.deltas = sorted(range(-tolerance_ms, tolerance_ms + 1), key=abs)
+        self.by_hash = {}
+        self.by_sound = {}
+        self.by_rounded = {}
+        self.by_ms = {}
+
+    @staticmethod
+    def keys(audio_id, duration):
+        if duration is None:
+            return None, None, None
+        duration = float(duration)
+        ms = round(duration * 1000)
+        if not audio_id:
+            return None, None, ms
+        return (audio_id, ms), (audio_id, round(duration, 1)), ms
+
+    def match(self, hash_=None, audio_id=None, duration=None):
+        # (source, is_potential), source is None for an original
+        sound, rounded, ms = self.keys(audio_id, duration)
+        if hash_ is not None and hash_ in self.by_hash:
+            return self.by_hash[hash_], False
+        if sound is not None and sound in self.by_sound:
+            return self.by_sound[sound], False
+        if rounded is not None and rounded in self.by_rounded:
+            return self.by_rounded[rounded], True
+        if ms is not None:
+            for delta in self.deltas:
+                if ms + delta in self.by_ms:
+                    return self.by_ms[ms + delta], True
+        return None, False
+
+    def add(self, item, hash_=None, audio_id=None, duration=None):
+        # first item wins, later ones never move a key
+        sound, rounded, ms = self.keys(audio_id, duration)
+        if hash_ is not None:
+            self.by_hash.setdefault(hash_, item)
+        if sound is not None:
+            self.by_sound.setdefault(sound, item)
+            self.by_rounded.setdefault(rounded, item)
+        if ms is not None:
+            self.by_ms.setdefault(ms, item)
+
+    def check(self, item, hash_=None, audio_id=None, duration=None):
+        source, is_potential = self.match(hash_, audio_id, duration)
+        self.add(item if source is None else source, hash_, audio_id, duration)
+        return source, is_potential
+
+
+if __name__ == '__main__':
+    # 100k reels of one model against the old dict-of-Decimal-keys loop
+    # (measured on 2k, it is quadratic). Run from app/: python -m libs.matcher
+    import random
+    import time
+    from decimal import Decimal
+
+    random.seed(1)
+    reels = [
+        {
+            'video_id': str(i), 'hash': f'{random.randrange(60000):064x}',
+            'audio_id': str(random.randrange(5000)),
+            'video_duration': round(random.uniform(5, 60), 3)
+        }
+        for i in range(100000)
+    ]
+
+    start = time.perf_counter()
+    matcher = DuplicateMatcher()
+    duplicates = 0
+    for reel in reels:
+        source, _ = matcher.check(reel, reel['hash'], reel['audio_id'], reel['video_duration'])
+        duplicates += source is not None
+    print(f'DuplicateMatcher: {len(reels)} reels, {duplicates} duplicates, {time.perf_counter() - start:.2f}s')
+
+    start = time.perf_counter()
+    sources = {}
+    for reel in reels[:2000]:
+        decimal = Decimal(reel['video_duration'])
+        keys = list(sources.keys())
+        found = (
+            reel['hash'] in keys or ('1', reel['audio_id'], reel['video_duration']) in keys
+            or any(decimal + Decimal(delta) in keys for delta in ['0', '0.001', '-0.001', '0.002', '-0.002'])
+        )
+        if not found:
+            sources[reel['hash']] = reel
+            sources[('1', reel['audio_id'], reel['video_duration'])] = reel
+            for delta in ['0', '0.001', '-0.001', '0.002', '-0.002']:
+                sources[decimal + Decimal(delta)] = reel
+    print(f'list(sources.keys()) loop: 2000 reels, {time.perf_counter() - start:.2f}s')
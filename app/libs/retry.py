@@ -0,0 +1,249 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from functools import wraps
+from urllib.parse import urlparse
+from libs.logs import logger, request_logger
+
+import aiohttp
+
+# methods that may be sent again after a network error: the request may
+# have reached the server, a repeated POST creates the records twice.
+# Airtable PATCH sets fields to the given values, repeating it is harmless.
+IDEMPOTENT = {'get', 'head', 'options', 'put', 'patch', 'delete'}
+
+
+def parse_retry_after(headers, now=None):
+    # Retry-After is either seconds or an HTTP date
+    # X-RateLimit-*-Reset is either seconds left or a unix timestamp
+    if not headers:
+        return None
+    if now is None:
+        now = time.time()
+    value = headers.get('Retry-After')
+    if value is not None:
+        try:
+            return max(0, float(value))
+        except ValueError:
+            try:
+                return max(0, parsedate_to_datetime(value).timestamp() - now)
+            except Exception:
+                pass
+    for name, value in headers.items():
+        name = name.lower()
+        if name.startswith('x-ratelimit') and (name.endswith('reset') or name.endswith('reset-after')):
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            if value > 1e9:
+                value = value - now
+            return max(0, value)
+    return None
+
+
+def is_exhausted(headers):
+    # X-RateLimit-Remaining: 0 (or X-RateLimit-Requests-Remaining for Rapid)
+    if not headers:
+        return False
+    for name, value in headers.items():
+        name = name.lower()
+        if name.startswith('x-ratelimit') and name.endswith('remaining'):
+            try:
+                if float(value) <= 0:
+                    return True
+            except ValueError:
+                pass
+    return False
+
+
+class CoolDown:
+    # Shared "hold on" signal per host (or per key inside a host, e.g. an
+    # Airtable base). One 429 pauses every coroutine that talks to the same
+    # host instead of each of them hitting it again.
+    def __init__(self, clock=time.monotonic, sleep=asyncio.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.until = {}
+
+    def trigger(self, host, seconds):
+        until = self.clock() + seconds
+        if until > self.until.get(host, 0):
+            self.until[host] = until
+
+    def remaining(self, host):
+        return max(0, self.until.get(host, 0) - self.clock())
+
+    async def wait(self, host):
+        remaining = self.remaining(host)
+        while remaining > 0:
+            await self.sleep(remaining)
+            remaining = self.remaining(host)
+
+
+class CircuitBreaker:
+    # closed -> (threshold failures in a row) -> open -> (reset_after) ->
+    # half open: one probe request goes through, everybody else waits for it
+    def __init__(self, threshold=5, reset_after=15, clock=time.monotonic, sleep=asyncio.sleep):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.sleep = sleep
+        self.failures = 0
+        self.opened_at = None
+        self.probe = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.probe is not None:
+            return 'half open'
+        return 'open'
+
+    async def wait(self):
+        while self.opened_at is not None:
+            remaining = self.opened_at + self.reset_after - self.clock()
+            if remaining > 0:
+                await self.sleep(remaining)
+            elif self.probe is None:
+                self.probe = asyncio.Event()
+                return
+            else:
+                await self.probe.wait()
+
+    def release(self):
+        if self.probe is not None:
+            self.probe.set()
+            self.probe = None
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.release()
+
+    def failure(self):
+        self.failures += 1
+        if self.probe is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit opened after {self.failures} failures")
+            self.opened_at = self.clock()
+        self.release()
+
+
+class RetryPolicy:
+    # Exponential backoff with full jitter. Server hints (Retry-After,
+    # X-RateLimit-*) win over the computed delay; 429 and exhausted quotas
+    # put the whole host on a shared cool-down. `lockout` - the least wait
+    # after a 429 without a hint (Airtable locks a base out for 30s).
+    # `key(api, *args, **kwargs)` narrows the cool-down to a part of the
+    # host, the same way Limiter.limit splits buckets.
+    def __init__(
+        self, attempts=6, base=1, cap=60, slow=35,
+        threshold=5, reset_after=15,
+        clock=time.monotonic, sleep=asyncio.sleep
+    ):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.slow = slow
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.sleep = sleep
+        self.cooldown = CoolDown(clock, sleep)
+        self.breakers = {}
+        self.retries = 0
+
+    def breaker(self, host):
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(
+                self.threshold, self.reset_after, self.clock, self.sleep
+            )
+        return self.breakers[host]
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def delay(self, attempt, headers=None, lockout=0):
+        hint = parse_retry_after(headers)
+        if hint is not None:
+            return min(self.cap, hint) + random.uniform(0, self.base)
+        if lockout:
+            return lockout + random.uniform(0, self.base)
+        return self.backoff(attempt)
+
+    @staticmethod
+    def is_retryable(status):
+        return status == 429 or status >= 500
+
+    @staticmethod
+    def get_host(api):
+        parsed = urlparse(api.base_url)
+        return parsed.netloc
+
+    def __call__(self, func, lockout=0, key=None):
+        # func(self, method, url, ...) -> (body, status, headers)
+        @wraps(func)
+        async def wrapper(api, *args, **kwargs):
+            host = self.get_host(api)
+            breaker = self.breaker(host)
+            scope = host
+            if key is not None:
+                scope = f'{host}:{key(api, *args, **kwargs)}'
+            idempotent = not args or str(args[0]).lower() in IDEMPOTENT
+            answer = None
+            for attempt in range(self.attempts):
+                await self.cooldown.wait(scope)
+                await breaker.wait()
+                start = self.clock()
+                try:
+                    answer = await func(api, *args, **kwargs)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    breaker.failure()
+                    if not idempotent or attempt + 1 == self.attempts:
+                        request_logger.error(f"{host} request failed: {e!r}")
+                        raise
+                    delay = self.backoff(attempt)
+                    request_logger.error(f"{host} request failed: {e!r}, retry in {delay:.1f}s")
+                    self.retries += 1
+                    await self.sleep(delay)
+                    continue
+                except BaseException:
+                    # CancelledError too: a cancelled probe must let the
+                    # next caller through, or the host hangs half open
+                    breaker.release()
+                    raise
+
+                status = answer[1]
+                headers = answer[2] if len(answer) > 2 else None
+                if status >= 500 or self.clock() - start > self.slow:
+                    breaker.failure()
+                else:
+                    breaker.success()
+
+                if is_exhausted(headers):
+                    hint = parse_retry_after(headers)
+                    if hint:
+                        self.cooldown.trigger(scope, min(self.cap, hint))
+
+                if not self.is_retryable(status) or attempt + 1 == self.attempts:
+                    return answer
+
+                delay = self.delay(attempt, headers, lockout if status == 429 else 0)
+                if status == 429:
+                    self.cooldown.trigger(scope, delay)
+                request_logger.warning(f"{scope} answered {status}, retry {attempt + 1} in {delay:.1f}s")
+                self.retries += 1
+                await self.sleep(delay)
+            return answer
+        return wrapper
+
+    def summary(self):
+        opened = [host for host, breaker in self.breakers.items() if breaker.state != 'closed']
+        cooling = [host for host in self.cooldown.until if self.cooldown.remaining(host) > 0]
+        return f"retries={self.retries} open={opened} cooling={cooling}"
+
+
+retry_policy = RetryPolicy()
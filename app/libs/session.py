@@ -0,0 +1,122 @@
+import asyncio
+import aiohttp
+from urllib.parse import urlparse
+from libs.logs import request_logger
+
+
+class SessionPool:
+    # One long-lived aiohttp.ClientSession per host. Keeps TCP/TLS connections
+    # alive between requests and caches DNS answers, so repeated calls to the
+    # same API don't pay for a new handshake every time.
+    # Hosts over max_hosts (link-in-bio pages, random CDNs) share one session
+    # so we don't keep a connector open for every domain we ever touched.
+    def __init__(self, limit=100, limit_per_host=30, dns_ttl=300, keepalive_timeout=30, timeout=None, max_hosts=32):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.max_hosts = max_hosts
+        self.sessions = {}
+
+    @staticmethod
+    def get_host(url):
+        parsed = urlparse(url)
+        return f'{parsed.scheme}://{parsed.netloc}'
+
+    def make_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        timeout = self.timeout
+        if timeout is None:
+            # total as aiohttp's default, a stuck request must not hold its slot forever
+            timeout = aiohttp.ClientTimeout(total=300, sock_connect=30, sock_read=300)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def get(self, url):
+        host = self.get_host(url)
+        if host not in self.sessions and len(self.sessions) >= self.max_hosts:
+            host = '*'
+        session = self.sessions.get(host)
+        if session is None or session.closed:
+            request_logger.debug(f"Open session for {host}")
+            session = self.make_session()
+            self.sessions[host] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        return self.get(url).request(method, url, **kwargs)
+
+    async def close(self):
+        sessions = list(self.sessions.values())
+        self.sessions = {}
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        # let the connectors finish closing the transports
+        if sessions:
+            await asyncio.sleep(0.25)
+
+
+session_pool = SessionPool()
+
+
+if __name__ == '__main__':
+    # Benchmark: requests per second against a local mock server with and
+    # without pooling. Run from app/: python -m libs.session
+    from aiohttp import web
+    import time
+
+    REQUESTS = 2000
+    CONCURRENCY = 50
+
+    async def handler(request):
+        return web.json_response({'ok': True})
+
+    async def run_server():
+        app = web.Application()
+        app.router.add_get('/', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f'http://127.0.0.1:{port}/'
+
+    async def without_pool(url):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                await response.json()
+
+    async def with_pool(pool, url):
+        async with pool.request('get', url) as response:
+            await response.json()
+
+    async def bench(name, factory):
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+
+        async def one():
+            async with semaphore:
+                await factory()
+
+        start = time.monotonic()
+        await asyncio.gather(*[one() for _ in range(REQUESTS)])
+        duration = time.monotonic() - start
+        print(f'{name}: {REQUESTS} requests in {duration:.3f}s - {REQUESTS / duration:.1f} rps')
+
+    async def main():
+        runner, url = await run_server()
+        try:
+            await bench('without pool', lambda: without_pool(url))
+            pool = SessionPool()
+            await bench('with pool', lambda: with_pool(pool, url))
+            await pool.close()
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
@@ -8,3 +8,5 @@ AIRTABLE_TOKEN_TikTok=os.getenv('AIRTABLE_TOKEN_TikTok')
 AIRTABLE_TOKEN_Twitter=os.getenv('AIRTABLE_TOKEN_Twitter')
 XRapidAPIHostTikTok=os.getenv('XRapidAPIHostTikTok')
 XRapidAPIHostTwitter=os.getenv('XRapidAPIHostTwitter')
+# all, errors, off or a fraction of requests to keep, e.g. 0.01
+REQUEST_ARCHIVE=os.getenv('REQUEST_ARCHIVE', 'all')
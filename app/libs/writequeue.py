@@ -0,0 +1,136 @@
+import asyncio
+from traceback import format_exc
+from libs.logs import error_logger, request_logger
+
+
+write_queues = []
+
+
+class AirtableWriteQueue:
+    # Write-behind queue for one Airtable table.
+    # - patches to the same record id are merged into one patch
+    # - records are sent in batches of `size` (Airtable takes 10 per call)
+    # - a batch goes out once it is full, `delay` seconds after the first
+    #   pending write, or on flush()/close() at the end of the pipeline
+    # Every call returns a future with the record from the answer, or a dict
+    # with an "error" key when the batch failed.
+    def __init__(self, api, baseName, tableName, mergeFields=None, size=10, delay=1.0):
+        self.api = api
+        self.baseName = baseName
+        self.tableName = tableName
+        self.mergeFields = mergeFields
+        self.size = size
+        self.delay = delay
+
+        self.updates = {}
+        self.creates = []
+        self.timer = None
+        self.tasks = set()
+
+        self.calls = 0
+        self.writes = 0
+
+    @property
+    def pending(self):
+        return len(self.updates) + len(self.creates)
+
+    def key(self, fields):
+        return tuple(str(fields.get(field)) for field in self.mergeFields)
+
+    def update(self, recordId, fields):
+        # upsert queues coalesce on mergeFields, update queues on record id
+        future = asyncio.get_running_loop().create_future()
+        if recordId not in self.updates:
+            self.updates[recordId] = [{}, []]
+        self.updates[recordId][0].update(fields)
+        self.updates[recordId][1].append(future)
+        self.writes += 1
+        self.schedule()
+        return future
+
+    def upsert(self, fields):
+        return self.update(self.key(fields), fields)
+
+    def create(self, fields):
+        future = asyncio.get_running_loop().create_future()
+        self.creates.append([fields, [future]])
+        self.writes += 1
+        self.schedule()
+        return future
+
+    def schedule(self):
+        if len(self.updates) >= self.size or len(self.creates) >= self.size:
+            self.spawn(self.flush(full_only=True))
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.spawn(self.flush())
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def take(self, full_only):
+        batches = []
+        while len(self.updates) >= self.size or (self.updates and not full_only):
+            keys = list(self.updates.keys())[:self.size]
+            batches.append(('update', [(key, *self.updates.pop(key)) for key in keys]))
+        while len(self.creates) >= self.size or (self.creates and not full_only):
+            items = self.creates[:self.size]
+            self.creates = self.creates[self.size:]
+            batches.append(('create', [(None, *item) for item in items]))
+        return batches
+
+    async def send(self, kind, batch):
+        if kind == 'create':
+            records = [{"fields": fields} for _, fields, _ in batch]
+            answer = await self.api.create_batch(self.baseName, self.tableName, records)
+        elif self.mergeFields is not None:
+            records = [{"fields": fields} for _, fields, _ in batch]
+            answer = await self.api.upsert(self.baseName, self.tableName, self.mergeFields, records)
+        else:
+            records = [{"id": key, "fields": fields} for key, fields, _ in batch]
+            answer = await self.api.upsert(self.baseName, self.tableName, None, records)
+        self.calls += 1
+        return answer
+
+    async def flush_batch(self, kind, batch):
+        try:
+            answer = await self.send(kind, batch)
+        except Exception as e:
+            error_logger.error(f'Airtable {kind} {self.baseName}/{self.tableName} failed\n{format_exc()}')
+            answer = {'error': repr(e)}
+        if not isinstance(answer, dict) or 'error' in answer or 'records' not in answer:
+            error_logger.error(f'Bad {kind} {self.baseName}/{self.tableName}: {batch}, error: {answer}')
+            results = [answer] * len(batch)
+        else:
+            results = answer['records']
+        for (_, _, futures), result in zip(batch, results):
+            for future in futures:
+                if not future.done():
+                    future.set_result(result)
+
+    async def flush(self, full_only=False):
+        batches = self.take(full_only)
+        if batches:
+            request_logger.debug(f'Airtable queue {self.tableName}: flush {len(batches)} batches')
+            await asyncio.gather(*[self.flush_batch(kind, batch) for kind, batch in batches])
+
+    async def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        await self.flush()
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks))
+
+    def summary(self):
+        return f'{self.tableName}: {self.writes} writes in {self.calls} calls, {self.pending} pending'
+
+
+async def close_write_queues():
+    for queue in write_queues:
+        await queue.close()
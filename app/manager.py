@@ -5,7 +5,7 @@ from libs.manager import manager
 def main():
     parser = ArgumentParser()
     parser.add_argument(
-        '-c', choices=['execs', 'exec', 'clear', 'active', 'today'], required=True
+        '-c', choices=['execs', 'exec', 'clear', 'active', 'today', 'request'], required=True
     )
     parser.add_argument(
         '-a'
@@ -22,6 +22,8 @@ def main():
         manager.show_active()
     elif argv.c == 'today':
         manager.show_today()
+    elif argv.c == 'request' and argv.a is not None:
+        manager.get_request(argv.a)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,24 @@
 import asyncio
-from libs.api import RapidTikTokApi, AirtableApi, _request_counter
+import libs.init
+from libs.api import RapidTikTokApi, AirtableApi, _request_counter, limiter
+from libs.retry import retry_policy
+from libs.marks import HighWaterMarks
+from cache.mirror import AirtableMirror
 from libs.settings import AIRTABLE_TOKEN_TikTok, XRapidAPIHostTikTok, XRapidAPIKey
 from libs.makepipeline import Step, Const, OUT
 from datetime import datetime
-from libs.utils import chunks
-from libs.logs import error_logger, execution_logger
+from libs.logs import execution_logger
 import psutil
 from os import getpid
 import re
 
 from sys import argv
 
-if len(argv) == 1:
+# python tiktok_script.py <view name> [resume=<exec id>]
+args = [arg for arg in argv[1:] if not arg.startswith('resume=')]
+resume = [arg.split('=', 1)[1] for arg in argv[1:] if arg.startswith('resume=')]
+
+if len(args) == 0:
     exit()
 
 airtabel = AirtableApi(
@@ -33,14 +40,25 @@ rapid = RapidTikTokApi(
 const = Const(
     BASE='Account Management',
     ACCOUNTS='TikTok Accounts',
-    ACCOUNTS_VIEW=' '.join(argv[1:]),
+    ACCOUNTS_VIEW=' '.join(args),
     VIDEOS='TikTok Videos',
     IG_ACCOUNTS='Instagram Accounts',
     USER_COUNT=None,
     POST_COUNT=80,
-    MARK=True
+    MARK=True,
+    # only fetch posts newer than the last run, views of older posts are
+    # not refreshed then
+    ONLY_NEW=False
 )
 
+# a mark moves only when all posts of the account were upserted in this
+# run (posts taken from a resumed journal do not count)
+marks = HighWaterMarks('./tiktok_marks.json')
+# account updates are merged per record and sent 10 at a time
+accounts = airtabel.write_queue(const.BASE, const.ACCOUNTS)
+# linked Instagram accounts are matched against the local mirror
+ig_accounts = AirtableMirror(airtabel, const.BASE, const.IG_ACCOUNTS, ["Username"])
+
 FIELDS = [
     "Account ID", "Created", "Model Record ID", "Username",
     "Average Views to calculate Viral Videos", "Follower",
@@ -57,6 +75,7 @@ if __name__ == '__main__':
         airtabel.load_cache("airtable_tiktok_db.json")
         await airtabel.init(const.BASE)
         airtabel.dump_cache("airtable_tiktok_db.json")
+        await ig_accounts.sync()
 
     async def _step2(data: None, context, const, pipe, iteration, step_number) -> list:
         # Get Accounts
@@ -101,13 +120,7 @@ if __name__ == '__main__':
                         "filename": "avatar"
                     }]
             if const.MARK:
-                answer = await airtabel.update(
-                    const.BASE, const.ACCOUNTS, data['id'], update
-                )
-                if "error" in answer:
-                    error_logger.error(
-                        f"Bad user update: {data}, error: {answer}"
-                    )
+                accounts.update(data['id'], update)
             data['fields']['Account ID'] = _data.get('uid')
             ig_acc = _data.get('ins_id', None)
             if not ig_acc:
@@ -119,43 +132,42 @@ if __name__ == '__main__':
                     ig_acc = match.group('ig_id')
 
             if ig_acc:
-                check = await airtabel.search_by_formula(
-                    const.BASE, const.IG_ACCOUNTS,
-                    f'LOWER(TRIM("{ig_acc}"))' + "=LOWER(TRIM({Username}))"
-                )
+                check = await ig_accounts.lookup({"Username": ig_acc}, ci=True)
                 if check:
-                    answer = await airtabel.update(
-                        const.BASE, const.ACCOUNTS, data['id'],
+                    accounts.update(
+                        data['id'],
                         {'Automatic - Linked Instagram Accounts': [check]}
                     )
-                    if "error" in answer:
-                        error_logger.error(f"Bad user update: {data}, error: {answer}")
             if _data.get('ins_id', None) is None:
-                answer = await airtabel.update(
-                    const.BASE, const.ACCOUNTS, data['id'],
+                accounts.update(
+                    data['id'],
                     {'Automatic - Linked Instagram Accounts': []}
                 )
 
             return data
         else:
             if const.MARK:
-                answer = await airtabel.update(
-                    const.BASE, const.ACCOUNTS, data['id'],
-                    {
-                        'Last Scraped': datetime.today().strftime("%Y-%m-%d"),
-                        'Status': "Potential Ban"
-                    }
-                )
-                if "error" in answer:
-                    error_logger.error(f"Bad user update: {data}, error: {answer}")
+                accounts.update(data['id'], {
+                    'Last Scraped': datetime.today().strftime("%Y-%m-%d"),
+                    'Status': "Potential Ban"
+                })
 
     async def _step4(data: dict, context, const, pipe, iteration, step_number) -> list | None:
         fields = data.get('fields', {})
         if fields:
             username = fields.get('Account ID', None)
             if username:
+                since = None
+                if fields.get('Created', None):
+                    since = datetime.fromisoformat(fields['Created'][:-1]).timestamp()
+                last_seen = None
+                mark = marks.get(username)
+                if const.ONLY_NEW and mark:
+                    last_seen = mark['id']
+                    since = max(since or 0, mark['created'])
                 _data = (await rapid.get_n_page(
-                    username, count=const.POST_COUNT
+                    username, count=const.POST_COUNT,
+                    since=since, last_seen=last_seen
                 )).get('aweme_list', None)
 
                 if isinstance(_data, list):
@@ -166,6 +178,9 @@ if __name__ == '__main__':
                 if _data:
                     _data = [item for item in _data if item.get('is_top', None) not in ['1', None]]
                     _data.sort(key=lambda item: -item['create_time'])
+                    if _data:
+                        # applied at the end if all of them were upserted
+                        marks.stage(data['id'], username, _data[0]['aweme_id'], _data[0]['create_time'], len(_data))
                     for i, item in enumerate(_data):
                         item["__meta"] = data
                         if i != len(_data) - 1:
@@ -173,19 +188,10 @@ if __name__ == '__main__':
                     return _data
                 else:
                     if const.MARK:
-                        await airtabel.update(
-                            const.BASE, const.ACCOUNTS, data['id'], {
-                                'Last Scraped': datetime.today().strftime("%Y-%m-%d"),
-                                'Status': "Potential Ban"
-                            }
-                        )
-
-    async def _step5(data: list, context, const, pipe, iteration, step_number) -> list:
-        _data = []
-        for items in data:
-            _data += items
-        execution_logger.info(f"Total: {len(_data)}")
-        return _data
+                        accounts.update(data['id'], {
+                            'Last Scraped': datetime.today().strftime("%Y-%m-%d"),
+                            'Status': "Potential Ban"
+                        })
 
     async def _step6(data: dict, context, const, pipe, iteration, step_number) -> dict | None:
         is_top = data.get('is_top', None)
@@ -223,18 +229,19 @@ if __name__ == '__main__':
                 if sound:
                     answer['Sound ID'] = str(added_sound_music_info.get('id', ''))
                 return {"fields": answer}
-
-    async def _step7(data: list, context, const, pipe, iteration, step_number) -> list:
-        execution_logger.info(f"After filter: {len(data)}")
-        answer = list(chunks(data, 10))
-        return answer
+        # not sent, does not hold the account's mark back
+        marks.done(__meta.get('id'))
 
     async def _step8(data: list, context, const, pipe, iteration, step_number) -> dict:
         answer = await airtabel.upsert(
             const.BASE, const.VIDEOS, ["VideoID"], data
         )
         if 'error' in answer:
-            error_logger.error(f"Bad video upsert: {data}, error: {answer}")
+            # raised, not returned: a failed batch is not journaled and is
+            # sent again on resume
+            raise Exception(f"Bad video upsert: {data}, error: {answer}")
+        for item in data:
+            marks.done(item['fields']['Account'][0])
         return answer
 
     async def _step9(data: list, context, const, pipe, iteration, step_number) -> None:
@@ -250,12 +257,15 @@ if __name__ == '__main__':
 
     step1 = Step(_step1, name='step_1', const=const)
     step2 = Step(_step2, name='step_2', const=const)
-    step3 = Step(_step3, name='step_3', const=const, isloop='aloop', mapper='records')
-    step4 = Step(_step4, name='step_4', const=const, isloop='aloop')
-    step5 = Step(_step5, name='step_5', const=const)
-    step6 = Step(_step6, name='step_6', const=const, isloop='aloop')
-    step7 = Step(_step7, name='step_7', const=const)
-    step8 = Step(_step8, name='step_8', const=const, isloop='aloop')
+    # keys for resume=<exec id>: items finished in that execution are skipped
+    step3 = Step(_step3, name='step_3', const=const, isloop='aloop', mapper='records', key=lambda item: item['id'])
+    step4 = Step(_step4, name='step_4', const=const, isloop='aloop', key=lambda item: item['id'])
+    step5 = Step(None, name='step_5', isloop='flatten')
+    step6 = Step(_step6, name='step_6', const=const, isloop='aloop', concurrency=50, key=lambda item: item.get('aweme_id'))
+    step7 = Step(None, name='step_7', isloop='batch', size=10)
+    # streamed batches are not the same in every run, so every video is
+    # journaled on its own and only the ones not sent yet are upserted
+    step8 = Step(_step8, name='step_8', const=const, isloop='aloop', key=lambda batch: [item['fields']['VideoID'] for item in batch])
     step9 = Step(_step9, name='step_9', const=const)
 
     pipe = step1 > step2
@@ -266,12 +276,19 @@ if __name__ == '__main__':
     pipe <= step7
     pipe <= step8
     pipe <= step9
+    # accounts, posts and upserts overlap instead of waiting for each other
+    pipe.set_stream()
+    if resume:
+        pipe.set_resume(resume[0])
 
     async def time_handler(self, elapsed):
         started = _request_counter["started"]
         ended = _request_counter["ended"]
 
         OUT.print(f"Requests: {started}/{ended}")
+        OUT.print(f"Limits: {limiter.summary()}")
+        OUT.print(f"Retries: {retry_policy.summary()}")
+        OUT.print(f"Writes: {accounts.summary()}")
         if self.current_loop:
             OUT.print(f"Active {self.current_loop['active']}, {self.current_loop['finished']}/{self.current_loop['max']}")
         OUT.print(f"{datetime.now().strftime('%H:%M:%S')} - {elapsed}")
@@ -284,3 +301,4 @@ if __name__ == '__main__':
     asyncio.run(pipe.run_with_timer(
         f"TikTok Scraping for {const.ACCOUNTS_VIEW}"
     ))
+    marks.save()
@@ -3,11 +3,10 @@ import libs.init
 
 from libs.api import AirtableApi, _request_counter
 from libs.settings import AIRTABLE_TOKEN_Twitter
-from libs.utils import chunks
 from datetime import datetime
 from libs.makepipeline import Step, Const, OUT
-from cache.models import TwitterUser
-from asgiref.sync import sync_to_async
+from cache.repository import TwitterUserRepository, database
+from cache.ingest import ingest
 
 const = Const(
     BASE='Twitter E-Mail Scraping Automation',
@@ -21,6 +20,7 @@ const = Const(
 airtabel = AirtableApi(
     "https://api.airtable.com/v0/", AIRTABLE_TOKEN_Twitter
 )
+tusers = TwitterUserRepository()
 
 if __name__ == '__main__':
 
@@ -30,77 +30,20 @@ if __name__ == '__main__':
         airtabel.dump_cache("airtable_twitter_db.json")
 
     async def _step2(data: None, context, const, pipe, iteration, step_number) -> dict:
-        accounts = await airtabel.search_until(
-            const.BASE, const.ACCOUNTS, None, const.ACCOUNTS_VIEW,
-            const.FIELDS
-        )
-        followers = await airtabel.search_until(
-            const.BASE, const.FOLLOWERS, None, const.FOLLOWERS_VIEW,
-            const.FIELDS
-        )
-        return [accounts, followers]
-
-    async def _step3(data: dict, context, const, pipe, iteration, step_number) -> list:
-        accounts, followers = data
-        for_create_accounts = []
-        for_create_followers = []
-        duplicates = set()
-        for account in accounts['records']:
-            id_ = account['fields'].get('User ID', '0')
-            if id_ != '0':
-                if account['fields']['User ID'] not in duplicates:
-                    duplicates.add(account['fields']['User ID'])
-                    for_create_accounts.append({
-                        'rapid_id': id_,
-                        'base': const.BASE,
-                        'table': const.ACCOUNTS,
-                    })
-        for follower in followers['records']:
-            id_ = follower['fields'].get('User ID', '0')
-            if id_ != '0':
-                if follower['fields']['User ID'] not in duplicates:
-                    duplicates.add(follower['fields']['User ID'])
-                    for_create_followers.append({
-                        'rapid_id': id_,
-                        'base': const.BASE,
-                        'table': const.FOLLOWERS,
-                    })
-        del duplicates
-        return [for_create_accounts, for_create_followers]
-
-    async def _step4(data: dict, context, const, pipe, iteration, step_number) -> list:
-        accounts, followers = data
-        accounts_tasks = []
-        followers_tasks = []
-        for accounts_ in list(chunks(accounts, 20)):
-            batch = []
-            for account in accounts_:
-                batch.append(TwitterUser(**account))
-            accounts_tasks.append(batch)
-        for followers_ in list(chunks(followers, 20)):
-            batch = []
-            for follower in followers_:
-                batch.append(TwitterUser(**follower))
-            followers_tasks.append(batch)
-
-        async_create = sync_to_async(
-            TwitterUser.objects.bulk_create, thread_sensitive=True
-        )
-        tasks = []
-        for reels in accounts_tasks:
-            tasks.append(async_create(reels))
-        for sounds in followers_tasks:
-            tasks.append(async_create(sounds))
-        await asyncio.gather(*tasks)
+        # accounts go first, an id that is in both tables stays an account
+        counts = {}
+        for table, view in [(const.ACCOUNTS, const.ACCOUNTS_VIEW), (const.FOLLOWERS, const.FOLLOWERS_VIEW)]:
+            counts[table] = await ingest(
+                tusers, airtabel.iter_search(const.BASE, table, None, view, const.FIELDS),
+                'User ID', extra={'base': const.BASE, 'table': table}
+            )
+        OUT.print(f"Copied: {counts}")
+        return counts
 
     step1 = Step(_step1, name='step_1', const=const)
     step2 = Step(_step2, name='step_2', const=const)
-    step3 = Step(_step3, name='step_3', const=const)
-    step4 = Step(_step4, name='step_4', const=const)
 
     pipe = step1 > step2
-    pipe <= step3
-    pipe <= step4
 
     async def time_handler(self, elapsed):
         started = _request_counter["started"]
@@ -112,6 +55,6 @@ if __name__ == '__main__':
         OUT.print(f"{datetime.now().strftime('%H:%M:%S')} - {elapsed}")
 
     pipe.set_time_handler(time_handler)
-    pipe.set_exec('7650e821-f21b-4587-b7fa-c4a4657a0553', ['step_2'])
+    pipe.on_shutdown(database.close)
 
     asyncio.run(pipe.run_with_timer("Make Twitter Cache"))
@@ -7,6 +7,7 @@ from libs.logs import error_logger, execution_logger
 from datetime import datetime
 from libs.utils import chunks
 from cache.models import TwitterUser
+from cache.dedup import TwitterUserDedup
 from asgiref.sync import sync_to_async
 import re
 
@@ -59,7 +60,7 @@ LA = LinkAnalizer('./linkanalizer.json', L, rapid_inst)
 if __name__ == '__main__':
 
     aget = sync_to_async(TwitterUser.objects.get, thread_sensitive=True)
-    acreate = sync_to_async(TwitterUser.objects.create, thread_sensitive=True)
+    tusers = TwitterUserDedup()
 
     async def check_user(airtabel_id=None, rapid_id=None):
         if airtabel_id is not None:
@@ -145,18 +146,25 @@ if __name__ == '__main__':
 
     async def _step4(data: dict, context, const, pipe, iteration, step_number) -> dict:
         objects = []
-        ids = set()
         for user in data:
-            for follower in user['ids']:
-                if follower not in ids and await check_tuser(follower, const):
-                    ids.add(follower)
-                    await acreate(rapid_id=follower)
-                    OUT.print(f'User {follower} was added!')
-                    execution_logger.info(f'User {follower} was added!')
-                    objects.append({
-                        'id': follower,
-                        'row_id': user['user_data']['id']
-                    })
+            followers = [str(follower) for follower in user['ids']]
+            if const.Ignore_Duplicates or not const.DB_local:
+                # checked in Airtable (or not at all), the db only records them
+                followers = [
+                    follower for follower in dict.fromkeys(followers)
+                    if follower not in tusers and await check_tuser(follower, const)
+                ]
+                await tusers.claim(followers)
+            else:
+                # one query per chunk instead of a get + create per follower
+                followers = await tusers.claim(followers)
+            for follower in followers:
+                OUT.print(f'User {follower} was added!')
+                execution_logger.info(f'User {follower} was added!')
+                objects.append({
+                    'id': follower,
+                    'row_id': user['user_data']['id']
+                })
         return objects
 
     async def _step8(data: dict, context, const, pipe, iteration, step_number) -> list:
@@ -258,9 +266,9 @@ we found this OF links:
     step2 = Step(_step2, name='step_2', const=const)
     step3 = Step(_step3, name='step_3', const=const, isloop='aloop', mapper='records')
     step4 = Step(_step4, name='step_4', const=const)
-    step8 = Step(_step8, name='step_8', const=const, isloop='aloop')
+    step8 = Step(_step8, name='step_8', const=const, isloop='aloop', concurrency=50)
     step9 = Step(_step9, name='step_9', const=const, isloop='aloop')
-    step10 = Step(_step10, name='step_10', const=const, isloop='aloop')
+    step10 = Step(_step10, name='step_10', const=const, isloop='aloop', concurrency=50)
     step12 = Step(_step12, name='step_12', const=const)
     step13 = Step(_step13, name='step_13', const=const, isloop='aloop')
 